@@ -0,0 +1,253 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+from __future__ import print_function
+from __future__ import division
+
+"""
+bench.py
+
+Throughput and memory benchmarks for conversion.
+
+Times `convert` for every pair of formats in FORMATS on short strings,
+paragraphs and a multi-megabyte input, and the `parse`/`emit` primitives of
+each format, on both realistic and synthetic text.
+
+    python bench.py                       # run everything
+    python bench.py --quick -k hepburn    # small inputs, matching cases only
+    python bench.py --save bench.json     # save results as JSON
+    python bench.py --compare bench.json  # flag regressions against a baseline
+"""
+
+import argparse
+import json
+import multiprocessing
+import platform
+import random
+import resource
+import sys
+import timeit
+
+from romajitool import *
+
+
+# Hiragana sample of everyday text, with sokuon, youon, nasals, long vowels
+#   and punctuation.
+SAMPLE_TEXT = """\
+きょう は とうきょう で しんぶん を よみ ながら、 まっちゃ を のみました。 \
+らーめん や ぎょうざ の みせ が たくさん あって、 ちょっと まよいました。 \
+きんえん の せき は ありますか。 こんや は きっと いっぱい でしょう。 \
+がっこう の せんせい に でんわ して、 しゅくだい に ついて きいて みました。 \
+ふっふっふ、 すーぱー で かった ぎゅうにゅう と ちーず は おいしかった です。"""
+
+SIZES = {
+    # name: (chars per string, total chars)
+    "short"     : (None, 20000),
+    "paragraph" : (500, 200000),
+    "large"     : (2 * 1024 * 1024, 2 * 1024 * 1024),
+}
+
+QUICK_SIZES = {
+    "short"     : (None, 2000),
+    "paragraph" : (500, 10000),
+    "large"     : (100 * 1024, 100 * 1024),
+}
+
+# slowdown beyond which a case is reported as a regression
+DEFAULT_THRESHOLD = 0.10
+
+
+def main(argv=None):
+    args = _parse_args(argv)
+    cases = build_cases(QUICK_SIZES if args.quick else SIZES, args.keyword)
+
+    results = []
+    for case in cases:
+        name = case[0]
+        result = _run_isolated(case, args.repeat)
+        results.append(result)
+        print("{:<45} {:>12,.0f} chars/s {:>9,} KiB".format(
+            name, result["chars_per_sec"], result["peak_kib"]))
+        sys.stdout.flush()
+
+    if args.save:
+        with open(args.save, "w") as save_file:
+            json.dump({"python": platform.python_version(),
+                       "quick": args.quick,
+                       "results": results},
+                      save_file, indent=1, sort_keys=True)
+
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            baseline = json.load(baseline_file)["results"]
+        regressions = compare(baseline, results, args.threshold)
+        for name, old, new in regressions:
+            print("REGRESSION {}: {:,.0f} -> {:,.0f} chars/s ({:+.1%})".format(
+                name, old, new, new / old - 1))
+        if regressions:
+            return 1
+    return 0
+
+
+def build_cases(sizes, keyword=None):
+    """
+    Return a list of (name, setup) benchmark cases, where calling `setup`
+    builds the case's input and returns (function, chars): calling
+    `function` processes `chars` characters.
+
+    Inputs are only built by `setup`, in the process measuring the case, so
+    its peak memory includes them. Only cases whose name contains `keyword`
+    are returned, if given.
+    """
+    rng = random.Random(0)
+    cases = []
+    realistic = {fmt: convert(SAMPLE_TEXT, "hiragana", fmt) for fmt in FORMATS}
+    synthetic = {fmt: _synthetic_text(FORMATS[fmt], rng) for fmt in FORMATS}
+
+    def wanted(name):
+        return keyword is None or keyword in name
+
+    for corpus_name, corpus in (("realistic", realistic),
+                                ("synthetic", synthetic)):
+        for in_fmt in sorted(FORMATS):
+            for size_name, (length, total) in sorted(sizes.items()):
+                for out_fmt in sorted(FORMATS):
+                    name = "convert/{}/{}/{}->{}".format(
+                        corpus_name, size_name, in_fmt, out_fmt)
+                    if not wanted(name):
+                        continue
+                    convert("", in_fmt, out_fmt)  # compile before forking
+                    cases.append((name, _convert_case(
+                        corpus[in_fmt], length, total, in_fmt, out_fmt)))
+
+            # primitives, on the large input only
+            fmt = FORMATS[in_fmt]
+            parse_name = "parse/{}/large/{}".format(corpus_name, in_fmt)
+            emit_name = "emit/{}/large/{}".format(corpus_name, in_fmt)
+            if wanted(parse_name):
+                cases.append((parse_name, _call_case(
+                    fmt.parse, corpus[in_fmt], sizes["large"])))
+            if wanted(emit_name):
+                cases.append((emit_name, _call_case(
+                    fmt.emit, corpus[in_fmt], sizes["large"], fmt.parse)))
+    return cases
+
+
+def compare(baseline, results, threshold=DEFAULT_THRESHOLD):
+    """
+    Return a list of (name, old, new) throughputs for cases in both `baseline`
+    and `results` that have slowed by more than `threshold`.
+    """
+    old_by_name = {result["name"]: result["chars_per_sec"] for result in baseline}
+    regressions = []
+    for result in results:
+        old = old_by_name.get(result["name"])
+        if old and result["chars_per_sec"] < old * (1 - threshold):
+            regressions.append((result["name"], old, result["chars_per_sec"]))
+    return regressions
+
+
+def _parse_args(argv):
+    parser = argparse.ArgumentParser(description="Benchmark romajitool.")
+    parser.add_argument("--quick", action="store_true",
+                        help="use small inputs")
+    parser.add_argument("-k", dest="keyword",
+                        help="only run cases whose name contains KEYWORD")
+    parser.add_argument("--repeat", type=int, default=3,
+                        help="timing runs per case; the fastest is kept")
+    parser.add_argument("--save", metavar="FILE",
+                        help="save results to FILE as JSON")
+    parser.add_argument("--compare", metavar="FILE",
+                        help="compare against results saved in FILE")
+    parser.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD,
+                        help="relative slowdown reported as a regression")
+    return parser.parse_args(argv)
+
+
+def _synthetic_text(fmt, rng, words=2000):
+    """
+    Return text of random words made of the format's surface keys.
+    """
+    keys = sorted(fmt._mapping.accepted_surface_substrings())
+    return " ".join("".join(rng.choice(keys) for _ in xrange(rng.randint(1, 6)))
+                    for _ in xrange(words))
+
+
+def _split(text, length, total):
+    """
+    Return strings cut from `text`, repeated as needed, totalling `total`
+    characters. With no `length`, split into words.
+    """
+    if length is None:
+        words = text.split()
+        strings = []
+        count = 0
+        while count < total:
+            word = words[len(strings) % len(words)]
+            strings.append(word)
+            count += len(word)
+        return strings
+    text = text * (total // len(text) + 1)
+    return [text[start:start + length] for start in xrange(0, total, length)]
+
+
+def _convert_case(text, length, total, in_fmt, out_fmt):
+    def setup():
+        strings = _split(text, length, total)
+
+        def run():
+            for string in strings:
+                convert(string, in_fmt, out_fmt)
+        return run, sum(len(string) for string in strings)
+    return setup
+
+
+def _call_case(function, text, size, prepare=None):
+    def setup():
+        argument = _split(text, *size)[0]
+        if prepare is not None:
+            argument = prepare(argument)
+
+        def run():
+            function(argument)
+        return run, len(argument)
+    return setup
+
+
+# case run by _measure in a forked process; functions can't be pickled
+_case = None
+
+
+def _run_isolated(case, repeat):
+    """
+    Run a case in a fresh process, so its peak memory is its own.
+    """
+    global _case
+    _case = case
+    pool = multiprocessing.Pool(1)
+    try:
+        return pool.apply(_measure, (repeat,))
+    finally:
+        pool.close()
+        pool.join()
+
+
+def _measure(repeat):
+    name, setup = _case
+    # a forked process's peak starts at its size when forked, which holds
+    #   no case inputs; they're built here
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    run, chars = setup()
+    run()
+    rss_after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    seconds = min(timeit.repeat(run, repeat=repeat, number=1))
+    return {"name": name,
+            "chars": chars,
+            "seconds": seconds,
+            "chars_per_sec": chars / seconds if seconds else float("inf"),
+            "peak_kib": rss_after - rss_before}
+
+
+if __name__ == '__main__':
+    sys.exit(main())
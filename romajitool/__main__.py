@@ -0,0 +1,8 @@
+#!/usr/bin/env python
+
+import sys
+
+import cli
+
+
+sys.exit(cli.main())
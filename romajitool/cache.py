@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+
+"""
+cache.py
+
+On-disk cache of compiled tables.
+
+Entries are plain data (dicts, tuples, strings) written with `marshal`, one
+file per entry, in a directory named after a hash of the table definitions
+and the code that compiles them. Editing defs.py therefore starts a fresh
+cache, and stale directories are simply ignored.
+
+The cache lives in $ROMAJITOOL_CACHE_DIR, or romajitool/ under
+$XDG_CACHE_HOME (~/.cache by default). Setting $ROMAJITOOL_CACHE_DIR to an
+empty string, or `CACHE_DIR` to None, disables it. Any error reading or
+writing an entry is treated as a cache miss.
+"""
+
+import hashlib
+import marshal
+import os
+import sys
+import tempfile
+
+import defs
+
+
+# modules whose contents determine the compiled tables
+_VERSIONED_SOURCES = ("defs.py", "util.py", "mapping.py", "lemmas.py",
+                      "textformat.py", "cache.py")
+
+
+def _default_dir():
+    path = os.environ.get("ROMAJITOOL_CACHE_DIR")
+    if path is not None:
+        return path or None
+    base = os.environ.get("XDG_CACHE_HOME") or \
+        os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(base, "romajitool")
+
+
+def _source_version():
+    """
+    Return a hash of the Python version and `_VERSIONED_SOURCES`,
+    or None if a source file can't be read.
+    """
+    digest = hashlib.sha1(sys.version.encode("ascii"))
+    package_dir = os.path.dirname(os.path.abspath(defs.__file__))
+    for name in _VERSIONED_SOURCES:
+        try:
+            with open(os.path.join(package_dir, name), "rb") as source:
+                digest.update(source.read())
+        except IOError:
+            # e.g. installed without sources; never reuse entries
+            return None
+    return digest.hexdigest()[:16]
+
+
+CACHE_DIR = _default_dir()
+
+_version = None
+
+
+def load(key):
+    """
+    Return the data cached under `key`, a tuple of strings, or None.
+    """
+    path = _entry_path(key)
+    if path is None:
+        return None
+    try:
+        with open(path, "rb") as entry:
+            return marshal.load(entry)
+    except (IOError, OSError, EOFError, ValueError, TypeError):
+        return None
+
+
+def save(key, data):
+    """
+    Cache `data` under `key`. The entry is written atomically, so concurrent
+    processes never see a partial file.
+    """
+    path = _entry_path(key)
+    if path is None:
+        return
+    directory = os.path.dirname(path)
+    try:
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        fd, tmp_path = tempfile.mkstemp(dir=directory)
+        try:
+            with os.fdopen(fd, "wb") as entry:
+                marshal.dump(data, entry)
+            os.rename(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+    except (IOError, OSError, ValueError):
+        pass
+
+
+def _entry_path(key):
+    global _version
+    if CACHE_DIR is None:
+        return None
+    if _version is None:
+        _version = _source_version() or ""
+    if not _version:
+        return None
+    name = hashlib.sha1(repr(key).encode("utf-8")).hexdigest()
+    return os.path.join(CACHE_DIR, _version, name + ".marshal")
@@ -0,0 +1,282 @@
+#!/usr/bin/env python
+
+from __future__ import unicode_literals
+from __future__ import print_function
+
+"""
+cli.py
+
+Command line interface. Converts files or stdin line by line, or counts the
+lemmas in them.
+
+    python -m romajitool --from hiragana --to hepburn [FILE ...]
+    python -m romajitool count --from hiragana [FILE ...]
+"""
+
+import argparse
+import collections
+import io
+import multiprocessing
+import sys
+import timeit
+
+import common
+import stats
+
+
+# number of lines converted per task with --jobs
+SHARD_LINES = 10000
+
+_FORMAT_CHOICES = [str(name) for name in sorted(common.FORMATS)]
+
+
+def main(argv=None):
+    """
+    Run the command line interface with the arguments `argv`
+    (defaults to sys.argv[1:]).
+    """
+    if argv is None:
+        argv = sys.argv[1:]
+    if argv[:1] == ["count"]:
+        return _count_main(argv[1:])
+    args = _parse_args(argv)
+    if args.stats:
+        common.reset_stats()
+        common.enable_stats()
+
+    # compile before any worker is forked, so workers inherit the tables
+    start = timeit.default_timer()
+    try:
+        common._load_pipeline(args.in_fmt, args.out_fmt,
+                              args.in_opts, args.out_opts)
+    except ValueError as e:
+        print("romajitool: error: {}".format(e), file=sys.stderr)
+        return 2
+    if args.stats:
+        stats.record_load(timeit.default_timer() - start)
+
+    if args.output is None:
+        out_file = io.open(sys.stdout.fileno(), "w", encoding=args.encoding,
+                           closefd=False)
+    else:
+        out_file = io.open(args.output, "w", encoding=args.encoding)
+
+    pool = multiprocessing.Pool(args.jobs) if args.jobs > 1 else None
+    try:
+        for path in args.files or ["-"]:
+            if path == "-":
+                in_file = io.open(sys.stdin.fileno(), encoding=args.encoding,
+                                  closefd=False)
+            else:
+                in_file = io.open(path, encoding=args.encoding)
+            with in_file:
+                if pool is None:
+                    _convert_lines(in_file, out_file, args)
+                else:
+                    _convert_parallel(in_file, out_file, args, pool)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+        out_file.close()
+        if args.stats:
+            common.enable_stats(False)
+            _print_stats(common.get_stats())
+    return 0
+
+
+def _parse_args(argv):
+    parser = argparse.ArgumentParser(
+        prog="romajitool",
+        description="Convert Japanese text between kana and romanization formats.")
+    parser.add_argument("files", nargs="*", metavar="FILE",
+                        help="files to convert; reads stdin if none or '-'")
+    parser.add_argument("-f", "--from", dest="in_fmt", required=True,
+                        choices=_FORMAT_CHOICES, help="input format")
+    parser.add_argument("-t", "--to", dest="out_fmt", required=True,
+                        choices=_FORMAT_CHOICES, help="output format")
+    parser.add_argument("--in-opt", dest="in_opts", action="append", default=[],
+                        metavar="OPT", help="input format option (repeatable)")
+    parser.add_argument("--out-opt", dest="out_opts", action="append", default=[],
+                        metavar="OPT", help="output format option (repeatable)")
+    parser.add_argument("-o", "--output", metavar="FILE",
+                        help="write to FILE instead of stdout")
+    parser.add_argument("-j", "--jobs", type=int, default=1, metavar="N",
+                        help="convert with N worker processes")
+    parser.add_argument("--encoding", default="utf-8",
+                        help="encoding of input and output (default: utf-8)")
+    parser.add_argument("--stats", action="store_true",
+                        help="print conversion statistics to stderr;"
+                             " calls count input lines")
+    args = parser.parse_args(argv)
+    if args.jobs < 1:
+        parser.error("--jobs must be at least 1")
+    return args
+
+
+def _count_main(argv):
+    """
+    Run the count subcommand with the arguments `argv`.
+    """
+    parser = argparse.ArgumentParser(
+        prog="romajitool count",
+        description="Count the lemmas in Japanese text, most frequent first,"
+                    " followed by the characters no key matched.")
+    parser.add_argument("files", nargs="*", metavar="FILE",
+                        help="files to count; reads stdin if none or '-'")
+    parser.add_argument("-f", "--from", dest="in_fmt", required=True,
+                        choices=_FORMAT_CHOICES, help="input format")
+    parser.add_argument("--in-opt", dest="in_opts", action="append", default=[],
+                        metavar="OPT", help="input format option (repeatable)")
+    parser.add_argument("-o", "--output", metavar="FILE",
+                        help="write to FILE instead of stdout")
+    parser.add_argument("-j", "--jobs", type=int, default=1, metavar="N",
+                        help="count with N worker processes")
+    parser.add_argument("--encoding", default="utf-8",
+                        help="encoding of input and output (default: utf-8)")
+    args = parser.parse_args(argv)
+    if args.jobs < 1:
+        parser.error("--jobs must be at least 1")
+
+    try:
+        counts = common.count_lemmas("", args.in_fmt, args.in_opts)
+    except ValueError as e:
+        print("romajitool: error: {}".format(e), file=sys.stderr)
+        return 2
+
+    pool = multiprocessing.Pool(args.jobs) if args.jobs > 1 else None
+    try:
+        for path in args.files or ["-"]:
+            if path == "-":
+                in_file = io.open(sys.stdin.fileno(), encoding=args.encoding,
+                                  closefd=False)
+            else:
+                in_file = io.open(path, encoding=args.encoding)
+            with in_file:
+                if pool is None:
+                    common.count_lemmas(in_file, args.in_fmt, args.in_opts,
+                                        counts)
+                else:
+                    _count_parallel(in_file, counts, args, pool)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    if args.output is None:
+        out_file = io.open(sys.stdout.fileno(), "w", encoding=args.encoding,
+                           closefd=False)
+    else:
+        out_file = io.open(args.output, "w", encoding=args.encoding)
+    with out_file:
+        _write_counts(counts, out_file)
+    return 0
+
+
+def _count_parallel(in_file, counts, args, pool):
+    """
+    Add the counts of `in_file` to `counts`, counting shards of SHARD_LINES
+    lines on `pool`.
+    """
+    pending = collections.deque()
+    for shard in _read_shards(in_file):
+        pending.append(pool.apply_async(
+            common.count_lemmas, (shard, args.in_fmt, args.in_opts)))
+        if len(pending) >= 2 * args.jobs:
+            counts.update(pending.popleft().get())
+    while pending:
+        counts.update(pending.popleft().get())
+
+
+def _write_counts(counts, out_file):
+    """
+    Write lemma counts as "LEMMA<tab>COUNT" lines, most frequent first, then
+    unconverted characters as "U+XXXX<tab>COUNT" lines.
+    """
+    for lemma, count in counts.lemmas.most_common():
+        out_file.write("{}\t{}\n".format(lemma, count))
+    for char, count in counts.unconverted.most_common():
+        out_file.write("U+{:04X}\t{}\n".format(ord(char), count))
+
+
+def _convert_lines(in_file, out_file, args):
+    """
+    Convert `in_file` to `out_file` one line at a time.
+    """
+    if args.stats:
+        for line in in_file:
+            out_file.write(common.convert(line, args.in_fmt, args.out_fmt,
+                                          args.in_opts, args.out_opts))
+        return
+    direct = common._load_pipeline(args.in_fmt, args.out_fmt,
+                                   args.in_opts, args.out_opts)
+    for line in in_file:
+        out_file.write(direct.parse(line))
+
+
+def _convert_parallel(in_file, out_file, args, pool):
+    """
+    Convert `in_file` to `out_file` in shards of SHARD_LINES lines on `pool`,
+    writing shards in their original order.
+
+    At most two shards per worker are in flight, so memory use is bounded.
+    """
+    pending = collections.deque()
+    for shard in _read_shards(in_file):
+        pending.append(pool.apply_async(
+            _convert_shard,
+            (shard, args.in_fmt, args.out_fmt, args.in_opts, args.out_opts,
+             args.stats)))
+        if len(pending) >= 2 * args.jobs:
+            _write_shard(pending.popleft().get(), out_file)
+    while pending:
+        _write_shard(pending.popleft().get(), out_file)
+
+
+def _write_shard(result, out_file):
+    out_str, shard_stats = result
+    out_file.write(out_str)
+    if shard_stats is not None:
+        stats.add(shard_stats)
+
+
+def _read_shards(in_file):
+    lines = []
+    for line in in_file:
+        lines.append(line)
+        if len(lines) == SHARD_LINES:
+            yield "".join(lines)
+            lines = []
+    if lines:
+        yield "".join(lines)
+
+
+def _convert_shard(shard, in_fmt, out_fmt, in_opts, out_opts, with_stats):
+    """
+    Return the converted shard, and its statistics if `with_stats`.
+    """
+    # no key spans a newline, so a shard converts the same as its lines
+    if not with_stats:
+        return common.convert(shard, in_fmt, out_fmt, in_opts, out_opts), None
+    # workers inherit the parent's totals when forked; count this shard only
+    common.reset_stats()
+    # a line at a time, so calls count lines as without --jobs
+    out_str = "".join(common.convert(line, in_fmt, out_fmt, in_opts, out_opts)
+                      for line in io.StringIO(shard))
+    return out_str, common.get_stats()
+
+
+def _print_stats(snapshot):
+    print("calls     {:,}, {:,} -> {:,} chars\n"
+          "matched   {:,} keys, {:,} chars passed through\n"
+          "lemmas    base {:,}, nasal {:,}, sokuon {:,}, chouon {:,}\n"
+          "time      load {:.3f}s, convert {:.3f}s".format(
+              snapshot.calls, snapshot.chars_in, snapshot.chars_out,
+              snapshot.matches, snapshot.passthrough,
+              snapshot.base, snapshot.nasal, snapshot.sokuon, snapshot.chouon,
+              snapshot.load_seconds, snapshot.convert_seconds),
+          file=sys.stderr)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
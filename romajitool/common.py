@@ -3,46 +3,834 @@
 from __future__ import unicode_literals
 from __future__ import print_function
 
+import bisect
+import collections
+import itertools
+import os
+import sys
+import threading
+import timeit
+
+import cache
 import defs
+import lemmas
+import mapping
+import stats
 import textformat
+import util
+
+
+class _Formats(collections.Mapping):
+    """
+    Read-only dict of format names to formats, building each on first access.
+    """
+
+    def __getitem__(self, name):
+        if name not in textformat.FORMAT_NAMES:
+            raise KeyError(name)
+        return textformat.get_format(name)
+
+    def __iter__(self):
+        return iter(textformat.FORMAT_NAMES)
+
+    def __len__(self):
+        return len(textformat.FORMAT_NAMES)
+
+    def __repr__(self):
+        return repr(list(textformat.FORMAT_NAMES))
+
+
+FORMATS = _Formats()
 
+# approximate number of characters converted per pass by convert_many
+BATCH_SIZE = 1 << 16
 
-FORMATS = {"hiragana" : textformat.HIRAGANA,
-           "wapuro"   : textformat.WAPURO}
+# default number of characters read per chunk by convert_stream,
+#   and bytes per window by convert_bytes
+CHUNK_SIZE = 1 << 16
+
+# number of compiled format pairs kept by convert and friends
+PIPELINE_CACHE_SIZE = 64
+
+# direct surface-to-surface mappings, keyed by (in_fmt, out_fmt, in_opts, out_opts)
+#   and composed on first use
+_PIPELINES = util.LRUCache(PIPELINE_CACHE_SIZE)
+
+# formats with options applied, keyed by (fmt, opts)
+_FORMAT_VARIANTS = util.LRUCache(PIPELINE_CACHE_SIZE)
+
+# tries of the same mappings encoded as UTF-8, for convert_bytes
+_BYTE_TRIES = util.LRUCache(PIPELINE_CACHE_SIZE)
+
+# romanizations whose spellings `spellings` mixes by default
+SPELLING_FORMATS = ("nihon", "kunrei", "hepburn")
+
+# emit tries of every variant of the formats given to `spellings`,
+#   keyed by the tuple of format names
+_SPELLING_TRIES = util.LRUCache(PIPELINE_CACHE_SIZE)
+
+# number of converted words kept by convert with `memoize`
+WORD_CACHE_SIZE = 1 << 16
+
+# converted words, keyed by (pipeline ID, word)
+_WORDS = util.GenerationalCache(WORD_CACHE_SIZE)
+
+# (pipeline ID, direct mapping) for convert with `memoize`, keyed as _PIPELINES
+_WORD_PIPELINES = util.LRUCache(PIPELINE_CACHE_SIZE)
+_word_pipeline_ids = itertools.count()
 
 
 #
 # public functions
 #
 
-def convert(in_str, in_fmt, out_fmt, in_opts=None, out_opts=None):
+def convert(in_str, in_fmt, out_fmt, in_opts=None, out_opts=None,
+            memoize=False, errors=None, mixed=False, with_alignment=False):
+    """
+    Convert `in_str` from the specified input format to the specified output format.
+
+    `in_opts` and `out_opts` are lists of options for romaji formats, applied
+    in order (see `textformat.ROMAJI_OPTIONS`).
+
+    The input and output formats' tables are precomposed into a single direct
+    mapping, so conversion is one pass without an intermediate string.
+    Compiled mappings are kept in a bounded LRU cache.
+
+    With `memoize`, `in_str` is split into words at characters that are part
+    of no key (spaces, punctuation, other scripts), and each word's conversion
+    is looked up in a cache of WORD_CACHE_SIZE words shared by all format
+    pairs (see `word_cache_info`), which is much faster for repetitive text.
+    No key spans those characters, so the result is the same.
+
+    With `mixed`, for text mostly in other scripts (log lines, URLs), only
+    runs of characters that are part of some key are scanned, and the text
+    between them is copied in bulk. `memoize` does the same.
+
+    Text that can't be converted is copied through, unless `errors` is:
+    "strict" -- raise mapping.ConversionError at the first such character
+    "replace" -- write mapping.REPLACEMENT_CHARACTER for each such character
+    "report" -- return (out_str, spans), where `spans` lists the
+        (start, end) offsets in `in_str` of the unconverted text
+    Errors are found in the same pass as the conversion. `memoize` and
+    `mixed` can't be used with `errors`, and raise ValueError.
+
+    With `with_alignment`, return (out_str, alignment), where `alignment` is
+    an array.array of four offsets for each key matched: its start in
+    `in_str` and in `out_str`, then its end in both (see `source_span`).
+    It is built in the same pass as the conversion; `memoize`, `mixed` and
+    `errors` can't be used with it, and raise ValueError.
+
+    Conversions are counted and timed while statistics are enabled
+    (see `enable_stats`), one call per `in_str`, however it is converted.
+    """
+    if with_alignment and (errors is not None or memoize or mixed):
+        raise ValueError("errors, memoize and mixed can't be used with"
+                         " with_alignment.")
+    if errors is not None and (memoize or mixed):
+        raise ValueError("memoize and mixed can't be used with errors.")
+    if stats.enabled:
+        return _convert_recorded(in_str, in_fmt, out_fmt, in_opts, out_opts,
+                                 memoize, errors, mixed, with_alignment)
+    if with_alignment:
+        return _load_pipeline(in_fmt, out_fmt, in_opts, out_opts).parse_aligned(
+            in_str)
+    if errors is not None:
+        return _load_pipeline(in_fmt, out_fmt, in_opts, out_opts).parse(
+            in_str, errors)
+    if memoize:
+        return _convert_memoized(in_str, in_fmt, out_fmt, in_opts, out_opts)
+    if mixed:
+        return _load_pipeline(in_fmt, out_fmt, in_opts, out_opts).parse_mixed(
+            in_str)
+    return _load_pipeline(in_fmt, out_fmt, in_opts, out_opts).parse(in_str)
+
+
+def convert_many(strings, in_fmt, out_fmt, in_opts=None, out_opts=None):
+    """
+    Convert each string in the iterable `strings` as `convert` would,
+    yielding results in order.
+
+    Formats are resolved once for the whole iterable, and consecutive strings
+    are joined into batches of roughly `BATCH_SIZE` characters so they are
+    converted in a single pass.
     """
-    Convert `in_str` from the specified input format to the specified output format
-    via an internal representation.
+    direct = _load_pipeline(in_fmt, out_fmt, in_opts, out_opts)
+
+    batch = []
+    batch_len = 0
+    for string in strings:
+        if _BATCH_SEPARATOR in string:
+            # can't be split back out of a batch
+            for out_str in _convert_batch(direct, batch):
+                yield out_str
+            batch = []
+            batch_len = 0
+            yield direct.parse(string)
+            continue
+        batch.append(string)
+        batch_len += len(string) + 1
+        if batch_len >= BATCH_SIZE:
+            for out_str in _convert_batch(direct, batch):
+                yield out_str
+            batch = []
+            batch_len = 0
+    for out_str in _convert_batch(direct, batch):
+        yield out_str
+
+
+def convert_concurrent(strings, in_fmt, out_fmt, in_opts=None, out_opts=None,
+                       max_workers=None):
     """
+    Return a list of the strings in `strings` converted as `convert` would,
+    in order, split into batches converted by `max_workers` threads (by
+    default, one per CPU).
+
+    The format pair is compiled before any worker starts, and its tables are
+    shared by all of them (see `mapping.Mapping`). Threads only convert in
+    parallel on an interpreter without a global interpreter lock; elsewhere
+    this is no faster than `convert_many`.
+    """
+    direct = _load_pipeline(in_fmt, out_fmt, in_opts, out_opts)
+    strings = list(strings)
+    if max_workers is None:
+        max_workers = _cpu_count()
+    if max_workers < 1:
+        raise ValueError("max_workers must be at least 1."
+                         " Got {} instead.".format(max_workers))
+
+    # several batches per worker, so workers finishing early can take more
+    total = sum(len(string) + 1 for string in strings)
+    batch_size = max(1, min(BATCH_SIZE, total // (4 * max_workers)))
+    batches = []
+    batch = []
+    batch_len = 0
+    for string in strings:
+        batch.append(string)
+        batch_len += len(string) + 1
+        if batch_len >= batch_size:
+            batches.append(batch)
+            batch = []
+            batch_len = 0
+    if batch:
+        batches.append(batch)
 
-    if in_opts == None:
-        in_opts = []
-    if out_opts == None:
-        out_opts = []
+    results = [None] * len(batches)
+    if max_workers == 1 or len(batches) <= 1:
+        for i, batch in enumerate(batches):
+            results[i] = _convert_strings(direct, batch)
+    else:
+        indices = iter(xrange(len(batches)))
+        lock = threading.Lock()
+        errors = []
+
+        def work():
+            while True:
+                with lock:
+                    i = next(indices, None)
+                if i is None or errors:
+                    return
+                try:
+                    results[i] = _convert_strings(direct, batches[i])
+                except Exception as e:
+                    errors.append(e)
+
+        workers = [threading.Thread(target=work)
+                   for _ in xrange(min(max_workers, len(batches)))]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        if errors:
+            raise errors[0]
+    return [out_str for result in results for out_str in result]
+
+
+def convert_bytes(data, out, in_fmt, out_fmt, in_opts=None, out_opts=None):
+    """
+    Convert the UTF-8 encoded text `data` as `convert` would, writing the
+    UTF-8 encoded result to `out`.
+
+    `data` may be a str, bytearray, memoryview or mmap, and `out` a
+    bytearray, which is extended, or a file opened in binary mode. Keys are
+    matched on the encoded bytes, so the input is never decoded, and it is
+    read, converted and written in windows of CHUNK_SIZE bytes.
+    """
+    key = (in_fmt, out_fmt, tuple(in_opts or ()), tuple(out_opts or ()))
+    trie = _BYTE_TRIES.get(key)
+    if trie is None:
+        direct = _load_pipeline(in_fmt, out_fmt, in_opts, out_opts)
+        trie = mapping._build_byte_trie(direct._surface_to_underlying)
+        _BYTE_TRIES.put(key, trie)
+
+    write = out.extend if isinstance(out, bytearray) else out.write
+    mapping._translate_bytes(trie, data, write, CHUNK_SIZE)
+
+
+def convert_array(values, in_fmt, out_fmt, in_opts=None, out_opts=None):
+    """
+    Convert each string in `values` as `convert` would, converting each
+    distinct string only once.
+
+    `values` may be a NumPy array of str or object dtype, a pandas Series or
+    any other iterable, and the result is of the same kind: an array of the
+    same shape and dtype kind, a Series with the same index, name and dtype,
+    or a list. Nulls (None and NaN, or pandas' NA) are kept as they are.
+
+    NumPy and pandas are optional; they are only used when `values` is one of
+    their types, and never imported here.
+    """
+    def convert_unique(uniques):
+        return list(convert_many(uniques, in_fmt, out_fmt, in_opts, out_opts))
+
+    pandas = sys.modules.get("pandas")
+    if pandas is not None and isinstance(values, pandas.Series):
+        return _convert_series(pandas, values, convert_unique)
+    numpy = sys.modules.get("numpy")
+    if numpy is not None and isinstance(values, numpy.ndarray):
+        return _convert_ndarray(numpy, values, convert_unique)
+
+    values = list(values)
+    uniques, codes = _factorize(values)
+    converted = convert_unique(uniques)
+    return [converted[code] if code >= 0 else value
+            for value, code in zip(values, codes)]
+
+
+def convert_stream(in_fileobj, out_fileobj, in_fmt, out_fmt,
+                   in_opts=None, out_opts=None, chunk_size=None):
+    """
+    Convert text read from `in_fileobj` and write it to `out_fileobj`,
+    reading `chunk_size` characters at a time.
+
+    Both file objects must handle text (e.g. opened with `io.open`). Text that
+    might be the start of a longer key is held back until the next chunk, so
+    the output is the same as converting the whole input at once.
+    """
+    converter = IncrementalConverter(in_fmt, out_fmt, in_opts, out_opts)
+    if chunk_size is None:
+        chunk_size = CHUNK_SIZE
+
+    while True:
+        chunk = in_fileobj.read(chunk_size)
+        if not chunk:
+            break
+        out_fileobj.write(converter.feed(chunk)[0])
+    out_fileobj.write(converter.flush())
+
+
+class IncrementalConverter(object):
+    """
+    Converts text as it arrives, a keystroke or chunk at a time, as an input
+    method would.
+
+    Input that might still be the start of a longer key (a lone "n", say, or a
+    consonant that may turn out to be doubled for sokuon) is held back until
+    more input decides it. Held-back input is always shorter than the longest
+    key, so each keystroke costs constant time however long the line grows.
+
+        >>> ime = IncrementalConverter("hepburn", "wapuro")
+        >>> ime.feed("shin")
+        (u'si', u'n')
+        >>> ime.feed("bun")
+        (u"n'bu", u'n')
+        >>> ime.flush()
+        u"n'"
+    """
+
+    def __init__(self, in_fmt, out_fmt, in_opts=None, out_opts=None):
+        """
+        Formats and options are as for `convert`.
+        """
+        self._direct = _load_pipeline(in_fmt, out_fmt, in_opts, out_opts)
+        self.pending = ""
+
+    def feed(self, text):
+        """
+        Add `text` to the input. Return (committed, pending), where `committed`
+        is the output that can no longer change and `pending` is the input
+        still held back.
+        """
+        committed, self.pending = self._direct.parse_partial(self.pending + text)
+        return committed, self.pending
+
+    def preview(self):
+        """
+        Return the output for the pending input if no more input were to come.
+        """
+        return self._direct.parse(self.pending)
+
+    def flush(self):
+        """
+        Return the output for the pending input, treating it as complete,
+        and clear it.
+        """
+        committed = self._direct.parse(self.pending)
+        self.pending = ""
+        return committed
+
+    def reset(self):
+        """
+        Discard the pending input.
+        """
+        self.pending = ""
+
+
+def count_lemmas(source, fmt, opts=None, counts=None, chunk_size=None):
+    """
+    Return a lemmas.LemmaCounts of the lemmas in `source`, in format `fmt`
+    with the options `opts`, and of the characters no key matched.
+
+    `source` is a string or a text file object, which is read `chunk_size`
+    characters at a time. No converted text is built, so memory use does not
+    grow with the input. Counts are added to `counts` if given; counts of
+    separate parts of a corpus, e.g. from different processes, can be added
+    together with `LemmaCounts.update`.
+    """
+    format_ = _load_format(fmt, opts)
+    if counts is None:
+        counts = lemmas.LemmaCounts()
+
+    if isinstance(source, unicode):
+        format_.count_lemmas(source, counts)
+        return counts
+    if chunk_size is None:
+        chunk_size = CHUNK_SIZE
+    pending = ""
+    while True:
+        chunk = source.read(chunk_size)
+        if not chunk:
+            break
+        text = pending + chunk
+        pending = text[format_.count_lemmas(text, counts, final=False):]
+    format_.count_lemmas(pending, counts)
+    return counts
+
+
+def source_span(alignment, start, end):
+    """
+    Return the (start, end) offsets of the input text converted to the output
+    text between `start` and `end`, using the `alignment` returned by
+    `convert` with `with_alignment`.
+
+    Spans covering only part of a key's output are widened to the whole key.
+    """
+    out_offsets = alignment[1::2]
+    # boundaries alternate between key starts (even) and key ends (odd)
+    i = bisect.bisect_right(out_offsets, start) - 1
+    if i < 0:
+        in_start = start
+    elif i % 2 == 0:
+        in_start = alignment[2 * i]
+    else:
+        in_start = alignment[2 * i] + start - out_offsets[i]
+
+    j = bisect.bisect_left(out_offsets, end)
+    if j == len(out_offsets):
+        in_end = (alignment[-2] + end - out_offsets[-1] if out_offsets
+                  else end)
+    elif j % 2 == 1 or out_offsets[j] == end:
+        in_end = alignment[2 * j]
+    else:
+        in_end = alignment[2 * j] - (out_offsets[j] - end)
+    return in_start, in_end
+
+
+def spellings(in_str, in_fmt, in_opts=None, out_fmts=SPELLING_FORMATS,
+              limit=None, keep=None):
+    """
+    Yield every distinct spelling of `in_str`, in format `in_fmt` with the
+    options `in_opts`, that the formats `out_fmts` can write, in sorted order.
 
-    # load formats
+    The spellings of all variants of the formats (each romaji format alone
+    and with each of `textformat.ROMAJI_OPTIONS`) are mixed key by key, so
+    the lemmas "SYATYO-" are spelled with "sha" or "sya", each followed by
+    every spelling of "TYO-". Keys a variant only spells as part of a longer
+    key are never completed with raw internal text; only lemmas that no
+    variant spells at all are written as in the internal representation.
+
+    Spellings are generated one character at a time and never held in
+    memory, so strings with millions of spellings can be enumerated lazily.
+    At most `limit` spellings are yielded. If `keep` is given, it is called
+    with each partial spelling, and those it returns False for are skipped
+    together with every spelling they start.
+    """
+    lemma_string = _load_format(in_fmt, in_opts).parse_lemmas(in_str)
+    key = tuple(out_fmts)
+    tries = _SPELLING_TRIES.get(key)
+    if tries is None:
+        tries = []
+        for out_fmt in key:
+            out_format = _load_format(out_fmt, None)
+            variants = [out_format]
+            if isinstance(out_format, textformat.RomajiFormat):
+                variants.extend(_load_format(out_fmt, [opt])
+                                for opt in sorted(textformat.ROMAJI_OPTIONS))
+            tries.extend(variant._mapping._emit_trie for variant in variants)
+        _SPELLING_TRIES.put(key, tries)
+
+    # Each variant's spelling of the longest key at each position of the
+    #   internal string, as (surface, end) pairs. Unconverted runs are copied
+    #   whole, and keys are only matched within the runs of lemmas between.
+    underlying = unicode(lemma_string)
+    length = len(underlying)
+    steps = [set() for _ in xrange(length)]
+    lemma_ends = {}
+    segments = []
+    segment_start = pos = 0
+    runs = iter(lemma_string.runs)
+    for lemma_id in lemma_string.ids:
+        if lemma_id == lemmas.PASSTHROUGH:
+            run = next(runs)
+            if segment_start < pos:
+                segments.append((segment_start, pos))
+            steps[pos].add((run, pos + len(run)))
+            segment_start = pos = pos + len(run)
+        else:
+            lemma_ends[pos] = pos = pos + len(defs.LEMMAS[lemma_id])
+    if segment_start < pos:
+        segments.append((segment_start, pos))
+    for segment_start, segment_end in segments:
+        segment = underlying[segment_start:segment_end]
+        for pos in xrange(segment_start, segment_end):
+            for trie in tries:
+                end, surface = mapping._longest_match(trie, segment,
+                                                      pos - segment_start)
+                if surface is not None:
+                    steps[pos].add((surface, segment_start + end))
+
+    # A lemma no key covers, in any context, is written as in the internal
+    #   string, as emit would. Anywhere else, a position no key starts at is
+    #   a dead end, as are the keys leading only to dead ends.
+    covered = [False] * (length + 1)
+    for pos in xrange(length):
+        for surface, end in steps[pos]:
+            for inner in xrange(pos + 1, end):
+                covered[inner] = True
+    for pos, end in lemma_ends.iteritems():
+        if not steps[pos] and not covered[pos]:
+            steps[pos].add((underlying[pos:end], end))
+    alive = [False] * length + [True]
+    for pos in xrange(length - 1, -1, -1):
+        steps[pos] = {(surface, end) for surface, end in steps[pos]
+                      if alive[end]}
+        alive[pos] = bool(steps[pos])
+    if not alive[0]:
+        return
+
+    # Walk the spellings as a trie of characters, tracking every way of
+    #   reading the prefix so far: as a key boundary `pos`, or as the first
+    #   `offset` characters of `surface` ending at `end`. Each prefix is
+    #   visited once, so no spelling is repeated.
+    def closure(states):
+        closed = set()
+        pending = list(states)
+        while pending:
+            state = pending.pop()
+            if state in closed:
+                continue
+            closed.add(state)
+            if len(state) == 1 and state[0] < length:
+                for surface, end in steps[state[0]]:
+                    pending.append((surface, end, 0) if surface else (end,))
+        return closed
+
+    count = 0
+    stack = [("", closure([(0,)]))]
+    while stack:
+        prefix, states = stack.pop()
+        if (length,) in states:
+            yield prefix
+            count += 1
+            if count == limit:
+                return
+        next_states = {}
+        for state in states:
+            if len(state) == 3:
+                surface, end, offset = state
+                next_states.setdefault(surface[offset], []).append(
+                    (end,) if offset + 1 == len(surface)
+                    else (surface, end, offset + 1))
+        for char in sorted(next_states, reverse=True):
+            spelling = prefix + char
+            if keep is None or keep(spelling):
+                stack.append((spelling, closure(next_states[char])))
+
+
+def pipeline_cache_info():
+    """
+    Return a CacheInfo of hits, misses, evictions and size for the cache of
+    compiled format pairs.
+    """
+    return _PIPELINES.info()
+
+
+def word_cache_info():
+    """
+    Return a CacheInfo of hits, misses, evictions and size for the cache of
+    converted words used by `convert` with `memoize`.
+    """
+    return _WORDS.info()
+
+
+def set_word_cache_size(maxsize):
+    """
+    Replace the cache of converted words with an empty one holding up to
+    `maxsize` words.
+    """
+    global _WORDS
+    _WORDS = util.GenerationalCache(maxsize)
+
+
+def enable_stats(enabled=True):
+    """
+    Start (or, if `enabled` is False, stop) recording statistics for
+    `convert`. Statistics recorded so far are kept.
+    """
+    stats.enabled = enabled
+
+
+def get_stats():
+    """
+    Return a stats.ConvertStats snapshot of the statistics recorded by
+    `convert`: time spent loading and converting, characters in and out,
+    matches, unconverted characters and lemmas matched per romaji table.
+    """
+    return stats.snapshot()
+
+
+def reset_stats():
+    """
+    Set the statistics recorded by `convert` back to zero.
+    """
+    stats.reset()
+
+
+#
+# private functions
+#
+
+# Private-use character that appears in no table, so no key can match across it.
+_BATCH_SEPARATOR = "\ue000"
+
+
+def _cpu_count():
+    """
+    Return the number of processors online, or 1 if it can't be found.
+
+    Asks the OS directly, as multiprocessing.cpu_count does, since importing
+    multiprocessing roughly doubles the time taken to import this module.
+    """
+    try:
+        return max(os.sysconf(b"SC_NPROCESSORS_ONLN"), 1)
+    except (AttributeError, ValueError, OSError):
+        pass
+    try:
+        # Windows has no sysconf
+        return max(int(os.environ["NUMBER_OF_PROCESSORS"]), 1)
+    except (KeyError, ValueError):
+        return 1
+
+
+def _load_pipeline(in_fmt, out_fmt, in_opts, out_opts):
+    """
+    Return the direct mapping from `in_fmt` to `out_fmt` with the given options,
+    compiling it on first use.
+    """
+    key = (in_fmt, out_fmt, tuple(in_opts or ()), tuple(out_opts or ()))
+    # before either cache, so invalid names fail whatever has been cached
+    _check_format("in_fmt", in_fmt, key[2])
+    _check_format("out_fmt", out_fmt, key[3])
+    direct = _PIPELINES.get(key)
+    if direct is not None:
+        return direct
+
+    state = cache.load(("pipeline",) + key)
+    if state is not None:
+        try:
+            direct = mapping.Mapping.from_state(state)
+        except (ValueError, TypeError):
+            direct = None
+        else:
+            _PIPELINES.put(key, direct)
+            return direct
+
+    in_format = FORMATS[in_fmt].with_options(key[2])
+    out_format = FORMATS[out_fmt].with_options(key[3])
+
+    direct = mapping.compose(in_format._mapping, out_format._mapping)
+    _PIPELINES.put(key, direct)
+    cache.save(("pipeline",) + key, direct.__getstate__())
+    return direct
+
+
+def _check_format(argument, fmt, opts):
+    """
+    Raise ValueError unless `fmt`, passed as `argument`, names a format
+    taking the options `opts`, without building it.
+    """
     try:
-        in_format = FORMATS[in_fmt]
+        accepted = textformat.format_options(fmt)
     except KeyError:
-        raise ValueError("in_fmt must be one of: {}."
-                         " Got '{}' instead.".format(FORMATS, in_fmt))
+        raise ValueError("{} must be one of: {}."
+                         " Got '{}' instead.".format(argument, FORMATS, fmt))
+    for opt in opts:
+        if opt not in accepted:
+            if not accepted:
+                raise ValueError("Format '{}' takes no options."
+                                 " Got {} instead.".format(fmt, list(opts)))
+            raise ValueError("Options for format '{}' must be among: {}."
+                             " Got '{}' instead.".format(
+                                 fmt, sorted(accepted), opt))
+
+
+def _load_format(fmt, opts):
+    """
+    Return the format `fmt` with the options `opts` applied, building the
+    variant on first use.
+    """
+    key = (fmt, tuple(opts or ()))
+    format_ = _FORMAT_VARIANTS.get(key)
+    if format_ is not None:
+        return format_
     try:
-        out_format = FORMATS[out_fmt]
+        format_ = FORMATS[fmt]
     except KeyError:
-        raise ValueError("out_fmt must be one of: {}."
-                         " Got '{}' instead.".format(FORMATS, out_fmt))
+        raise ValueError("fmt must be one of: {}."
+                         " Got '{}' instead.".format(FORMATS, fmt))
+    format_ = format_.with_options(key[1])
+    _FORMAT_VARIANTS.put(key, format_)
+    return format_
 
-    # map to output format
-    intermediate = in_format.parse(in_str)
-    out_str = out_format.emit(intermediate).lower()
 
-    return out_str
+def _convert_memoized(in_str, in_fmt, out_fmt, in_opts, out_opts):
+    """
+    Convert as `convert` does, a word at a time through the word cache.
+    """
+    key = (in_fmt, out_fmt, tuple(in_opts or ()), tuple(out_opts or ()))
+    word_pipeline = _WORD_PIPELINES.get(key)
+    if word_pipeline is None:
+        direct = _load_pipeline(in_fmt, out_fmt, in_opts, out_opts)
+        word_pipeline = (next(_word_pipeline_ids), direct)
+        _WORD_PIPELINES.put(key, word_pipeline)
+    pipeline_id, direct = word_pipeline
+
+    words = _WORDS
+    parts = direct.split_key_runs(in_str)
+    for i in xrange(1, len(parts), 2):
+        word_key = (pipeline_id, parts[i])
+        out_word = words.get(word_key)
+        if out_word is None:
+            out_word = direct.parse(parts[i])
+            words.put(word_key, out_word)
+        parts[i] = out_word
+    return "".join(parts)
+
+
+def _convert_recorded(in_str, in_fmt, out_fmt, in_opts, out_opts, memoize,
+                      errors, mixed, with_alignment):
+    """
+    Convert as `convert` does, with the same options, recording statistics.
+    """
+    timer = timeit.default_timer
+    start = timer()
+    direct = _load_pipeline(in_fmt, out_fmt, in_opts, out_opts)
+    loaded = timer()
+    if with_alignment:
+        out = direct.parse_aligned(in_str)
+    elif errors is not None:
+        out = direct.parse(in_str, errors)
+    elif memoize:
+        out = _convert_memoized(in_str, in_fmt, out_fmt, in_opts, out_opts)
+    elif mixed:
+        out = direct.parse_mixed(in_str)
+    else:
+        out = direct.parse(in_str)
+    converted = timer()
+    stats.record(in_fmt, tuple(in_opts or ()), direct, in_str,
+                 out[0] if with_alignment or errors == "report" else out,
+                 loaded - start, converted - loaded)
+    return out
+
+
+def _factorize(values):
+    """
+    Return (uniques, codes), where `uniques` lists the distinct values of
+    `values` in order of appearance and `codes` gives the index in `uniques`
+    of each value, or -1 for nulls (None and NaN).
+    """
+    index = {}
+    codes = []
+    append = codes.append
+    for value in values:
+        if value is None or isinstance(value, float) and value != value:
+            append(-1)
+            continue
+        code = index.get(value)
+        if code is None:
+            code = index[value] = len(index)
+        append(code)
+    uniques = [None] * len(index)
+    for value, code in index.iteritems():
+        uniques[code] = value
+    return uniques, codes
+
+
+def _convert_ndarray(numpy, values, convert_unique):
+    """
+    `convert_array` for a NumPy array of str or object dtype.
+    """
+    if values.dtype.kind == "U":
+        uniques, codes = numpy.unique(values, return_inverse=True)
+        converted = numpy.array(convert_unique(uniques.tolist()),
+                                dtype=numpy.unicode_)
+        return converted.take(codes).reshape(values.shape)
+    if values.dtype.kind != "O":
+        raise TypeError("Array must be of str or object dtype."
+                        " Got {} instead.".format(values.dtype))
+
+    flat = values.ravel()
+    uniques, codes = _factorize(flat)
+    codes = numpy.array(codes, dtype=numpy.intp)
+    # the extra last entry is taken for nulls, then replaced by the originals
+    converted = numpy.array(convert_unique(uniques) + [None], dtype=object)
+    result = converted.take(codes)
+    nulls = codes == -1
+    result[nulls] = flat[nulls]
+    return result.reshape(values.shape)
+
+
+def _convert_series(pandas, values, convert_unique):
+    """
+    `convert_array` for a pandas Series.
+    """
+    numpy = sys.modules["numpy"]  # imported by pandas
+
+    codes, uniques = pandas.factorize(values)
+    converted = numpy.array(convert_unique(list(uniques)) + [None], dtype=object)
+    result = converted.take(codes)
+    nulls = codes == -1
+    result[nulls] = numpy.asarray(values, dtype=object)[nulls]
+    return pandas.Series(result, index=values.index, name=values.name,
+                         dtype=object).astype(values.dtype.name)
+
+
+def _convert_batch(direct, strings):
+    """
+    Convert a list of strings with `direct` in a single pass.
+    """
+    if not strings:
+        return []
+    return direct.parse(_BATCH_SEPARATOR.join(strings)).split(_BATCH_SEPARATOR)
+
+
+def _convert_strings(direct, strings):
+    """
+    Convert a list of strings with `direct`, in a single pass unless one of
+    them can't be batched.
+    """
+    if any(_BATCH_SEPARATOR in string for string in strings):
+        return [direct.parse(string) for string in strings]
+    return _convert_batch(direct, strings)
 
 
 # def to_wapuro(in_str):
@@ -74,6 +74,7 @@ LEMMA_TAB_SMALL_KANA_POST = "XA XI XU XE XO   XYA XYU XYO   XWA"
 # special lemmas
 LEMMA_SOKUON = "Q"
 LEMMA_CHOUON = "-"
+LEMMA_NASAL  = "N'"
 
 
 #----------------------------------------------------------------------------
@@ -127,6 +128,14 @@ HIRAGANA_TAB = util.read_table("""\
 ー -
 """)
 
+# Katakana are the hiragana code points shifted by a fixed offset,
+#   so katakana tables are derived from HIRAGANA_TAB with `unicode.translate`.
+# Half-width katakana are derived from these in textformat.
+KATAKANA_OFFSET = 0x60
+HIRAGANA_TO_KATAKANA = {code: code + KATAKANA_OFFSET
+                        for code in xrange(ord("ぁ"), ord("ゖ") + 1)}
+KATAKANA_TO_HIRAGANA = {kata: hira for hira, kata in HIRAGANA_TO_KATAKANA.iteritems()}
+
 
 #----------------------------------------------------------------------------
 # Romaji conversion tables
@@ -185,10 +194,12 @@ ya YA,        yu YU,        yo YO,
 ra RA, ri RI, ru RU, re RE, ro RO, rya RYA, ryu RYU, ryo RYO,
 wa WA,
 
-kwa KWA,
-gwa GWA
+n  N'
 """)
 
+# を is pronounced and, by default, spelled o
+ROMAJI_MORAS_BASE_OUTONLY = util.read_table("o WO")
+
 MORAS_NIHON = util.read_table("""\
 si SI,
 zi ZI,
@@ -214,7 +225,7 @@ tya TYA, tyu TYU, tyo TYO
 """)
 
 MORAS_KUNREI_OUTONLY = util.read_table("""
-zi DI, zu DU, zya DYA, dyu DYU, zyu DYO
+zi DI, zu DU, zya DYA, zyu DYU, zyo DYO
 """)
 
 MORAS_HEPBURN = util.read_table("""\
@@ -234,11 +245,11 @@ ji DI, zu DU, ja DYA, ju DYU, jo DYO
 
 ARCHAIC_WAGYO_RETAIN_W = util.read_table("wi WI, we WE, wo WO")
 
-ARCHAIC_WAGYO_DROP_W = util.read_table("i WE, e WE, o WO")
+ARCHAIC_WAGYO_DROP_W = util.read_table("i WI, e WE, o WO")
 
 MORAS_EXTENDED = util.read_table("""\
          wi  UXI,  wu UXU,  we  UXE, wo   UXO,
-va  VA,  vi  VI,   vu U,    ve  VE,  vo   VO,  vya VYA, vyu VYU, vyo VYO,
+va  VA,  vi  VI,   vu VU,   ve  VE,  vo   VO,  vya VYA, vyu VYU, vyo VYO,
                             she SYE,
                             je  ZYE,
          ti  TEXI, tu TOXU,
@@ -297,10 +308,10 @@ oo O-
 
 NASAL_BASE = util.read_table("""\
 n'a N'A,
-n'i N'A,
-n'u N'A,
-n'e N'A,
-n'o N'A,
+n'i N'I,
+n'u N'U,
+n'e N'E,
+n'o N'O,
 nk  N'K,
 ng  N'G,
 ns  N'S,
@@ -317,7 +328,8 @@ nw  N'W
 
 NASAL_EXTENDED = util.read_table("""\
 nj N'J,
-nf N'F, 
+nc N'C,
+nf N'F,
 nv N'V
 """)
 
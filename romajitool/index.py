@@ -0,0 +1,419 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+
+"""
+index.py
+
+Spelling-insensitive search index. Documents and queries, in any format, are
+normalized to sequences of lemmas, so "shinbun", "sinbun", "しんぶん" and
+"シンブン" all find the same documents.
+
+    idx = LemmaIndex()
+    idx.add("doc-1", "とうきょう の しんぶん", "hiragana")
+    idx.search("tōkyō shinbun", "hepburn", ["macron"])    # ["doc-1"]
+    idx.save("catalog.idx")
+    idx = LemmaIndex.load("catalog.idx")                   # memory-mapped
+
+Lemma sequences are kept as strings with one character per lemma ID, and
+the index maps every run of 1 to `n` consecutive lemmas (an n-gram) to the
+documents containing it. Text no key matches (spaces, punctuation, other
+scripts) separates runs; no n-gram spans it.
+"""
+
+import array
+import marshal
+import mmap
+import os
+import struct
+import sys
+import tempfile
+
+import common
+import defs
+import lemmas
+
+
+# longest n-gram indexed by default
+DEFAULT_N = 2
+
+# stands for each run of unconverted text in a lemma sequence
+SEPARATOR = unichr(lemmas.PASSTHROUGH)
+
+_VOWELS = "AIUEO"
+
+# vowel each lemma ends in, or None
+_VOWEL_OF = tuple(lemma[-1] if lemma[-1] in _VOWELS else None
+                  for lemma in defs.LEMMAS)
+
+# lemmas that only lengthen the vowel before them, keyed by that vowel:
+#   chouon, the same vowel again, and "u" after "o" as in "toukyou"
+_LENGTHENING = {vowel: frozenset([lemmas.LEMMA_IDS[defs.LEMMA_CHOUON],
+                                  lemmas.LEMMA_IDS[vowel]])
+                for vowel in _VOWELS}
+_LENGTHENING["O"] |= {lemmas.LEMMA_IDS["U"]}
+
+_MAGIC = b"RTLX"
+_VERSION = 1
+
+# magic, version, n, fold_long_vowels, and the number of documents, n-grams,
+#   postings, lemmas in all sequences, and bytes of document IDs
+_HEADER = struct.Struct(b"<4sHHHIIIII")
+
+
+def normalize(text, fmt, opts=None, fold_long_vowels=True):
+    """
+    Return `text`, in format `fmt` with the options `opts`, as a lemma
+    sequence: a string of the characters whose code points are its lemma
+    IDs, with SEPARATOR for each run of unconverted text.
+
+    With `fold_long_vowels`, lemmas that only lengthen the vowel before them
+    are dropped, so "tōkyō", "toukyou", "tookyoo" and "tokyo" are the same.
+    """
+    ids = common._load_format(fmt, opts).parse_lemmas(text).ids
+    if not fold_long_vowels:
+        return "".join(map(unichr, ids))
+    out = []
+    append = out.append
+    lengthening = ()
+    for lemma_id in ids:
+        if lemma_id == lemmas.PASSTHROUGH:
+            append(SEPARATOR)
+            lengthening = ()
+        elif lemma_id not in lengthening:
+            append(unichr(lemma_id))
+            vowel = _VOWEL_OF[lemma_id]
+            lengthening = _LENGTHENING[vowel] if vowel else ()
+    return "".join(out)
+
+
+class LemmaIndex(object):
+    """
+    Inverted index from lemma n-grams of up to `n` lemmas to documents,
+    normalized as by `normalize` with `fold_long_vowels`.
+
+    Document IDs may be any hashable value `marshal` can write, such as
+    strings, numbers, or tuples of them.
+    """
+
+    def __init__(self, n=DEFAULT_N, fold_long_vowels=True):
+        if n < 1:
+            raise ValueError("n must be at least 1. Got {} instead.".format(n))
+        self.n = n
+        self.fold_long_vowels = fold_long_vowels
+        # lemma sequences and postings of documents added in memory
+        self._docs = {}
+        self._postings = {}
+        # loaded _MappedIndex, and the numbers of its documents since
+        #   removed or replaced
+        self._base = None
+        self._removed = set()
+
+    def __len__(self):
+        base_count = self._base.doc_count - len(self._removed) if self._base else 0
+        return len(self._docs) + base_count
+
+    def __contains__(self, doc_id):
+        return doc_id in self._docs or self._base_number(doc_id) is not None
+
+    def add(self, doc_id, text, fmt, opts=None):
+        """
+        Index the document `doc_id` with the text `text`, in format `fmt`
+        with the options `opts`, replacing any document with the same ID.
+        """
+        sequence = normalize(text, fmt, opts, self.fold_long_vowels)
+        if doc_id in self:
+            self.remove(doc_id)
+        self._docs[doc_id] = sequence
+        postings = self._postings
+        for gram in _grams(sequence, self.n):
+            doc_ids = postings.get(gram)
+            if doc_ids is None:
+                doc_ids = postings[gram] = set()
+            doc_ids.add(doc_id)
+
+    def remove(self, doc_id):
+        """
+        Remove the document `doc_id` from the index.
+
+        Raises KeyError if there is no such document.
+        """
+        sequence = self._docs.pop(doc_id, None)
+        if sequence is None:
+            number = self._base_number(doc_id)
+            if number is None:
+                raise KeyError(doc_id)
+            self._removed.add(number)
+            return
+        postings = self._postings
+        for gram in _grams(sequence, self.n):
+            doc_ids = postings[gram]
+            doc_ids.discard(doc_id)
+            if not doc_ids:
+                del postings[gram]
+
+    def search(self, query, fmt, opts=None):
+        """
+        Return a sorted list of the IDs of the documents containing every
+        run of lemmas in `query`, in format `fmt` with the options `opts`.
+
+        Runs longer than `n` lemmas are found through their n-grams, then
+        checked against each candidate's lemma sequence.
+        """
+        runs = [run for run in normalize(query, fmt, opts,
+                                         self.fold_long_vowels).split(SEPARATOR)
+                if run]
+        if not runs:
+            return []
+        grams = set()
+        for run in runs:
+            grams.update(_query_grams(run, self.n))
+
+        found = []
+        candidates = _intersect(self._postings.get(gram, ()) for gram in grams)
+        for doc_id in candidates:
+            sequence = self._docs[doc_id]
+            if all(run in sequence for run in runs):
+                found.append(doc_id)
+
+        base = self._base
+        if base is not None:
+            candidates = _intersect(base.postings(gram) for gram in grams)
+            for number in candidates - self._removed:
+                sequence = base.sequence(number)
+                if all(run in sequence for run in runs):
+                    found.append(base.doc_ids[number])
+        return sorted(found)
+
+    def save(self, path):
+        """
+        Write the index to the file at `path`, for `load`. The file is
+        written atomically, so readers never see a partial index.
+        """
+        docs = list(self._iter_docs())
+        postings = {}
+        for number, (doc_id, sequence) in enumerate(docs):
+            for gram in _grams(sequence, self.n):
+                numbers = postings.get(gram)
+                if numbers is None:
+                    numbers = postings[gram] = []
+                numbers.append(number)
+
+        padding = SEPARATOR * self.n
+        grams = sorted(postings, key=lambda gram: (gram + padding)[:self.n])
+        gram_offsets = array.array(b"I", [0])
+        posting_numbers = array.array(b"I")
+        for gram in grams:
+            posting_numbers.extend(postings[gram])
+            gram_offsets.append(len(posting_numbers))
+        doc_offsets = array.array(b"I", [0])
+        sequences = []
+        for doc_id, sequence in docs:
+            sequences.append(sequence)
+            doc_offsets.append(doc_offsets[-1] + len(sequence))
+        doc_ids = marshal.dumps([doc_id for doc_id, sequence in docs])
+
+        sections = ["".join((gram + padding)[:self.n]
+                            for gram in grams).encode("utf-16-le"),
+                    _little_endian(gram_offsets),
+                    _little_endian(posting_numbers),
+                    _little_endian(doc_offsets),
+                    "".join(sequences).encode("utf-16-le"),
+                    doc_ids]
+        header = _HEADER.pack(_MAGIC, _VERSION, self.n, self.fold_long_vowels,
+                              len(docs), len(grams), len(posting_numbers),
+                              doc_offsets[-1], len(doc_ids))
+
+        directory = os.path.dirname(os.path.abspath(path))
+        fd, tmp_path = tempfile.mkstemp(dir=directory)
+        try:
+            with os.fdopen(fd, "wb") as out_file:
+                out_file.write(header)
+                for section in sections:
+                    out_file.write(section)
+            os.rename(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+    @classmethod
+    def load(cls, path):
+        """
+        Return the index saved at `path`.
+
+        The file is memory-mapped, and only the document IDs are read into
+        memory. Documents added or removed afterwards are kept in memory
+        until the index is saved again.
+
+        Raises ValueError if the file is not a saved index.
+        """
+        base = _MappedIndex(path)
+        self = cls(base.n, base.fold_long_vowels)
+        self._base = base
+        return self
+
+    def close(self):
+        """
+        Unmap the file the index was loaded from, dropping its documents.
+        """
+        if self._base is not None:
+            self._base.close()
+            self._base = None
+            self._removed = set()
+
+    def _base_number(self, doc_id):
+        """
+        Return the number of the document `doc_id` in the loaded file, or
+        None if it isn't there or was removed.
+        """
+        if self._base is None:
+            return None
+        number = self._base.numbers.get(doc_id)
+        if number in self._removed:
+            return None
+        return number
+
+    def _iter_docs(self):
+        """
+        Iterate over (doc_id, sequence) for every document.
+        """
+        base = self._base
+        if base is not None:
+            for number, doc_id in enumerate(base.doc_ids):
+                if number not in self._removed:
+                    yield doc_id, base.sequence(number)
+        for item in self._docs.iteritems():
+            yield item
+
+
+class _MappedIndex(object):
+    """
+    Read-only view of an index file saved by `LemmaIndex.save`.
+
+    The file holds, after the header: the sorted n-grams, each padded to `n`
+    lemmas with SEPARATOR, as UTF-16-LE; the offset of each n-gram's postings
+    and the postings, document numbers, as little-endian uint32s; the offset
+    of each document's sequence, likewise; the sequences, as UTF-16-LE; and
+    the document IDs, as a marshalled list.
+    """
+
+    def __init__(self, path):
+        with open(path, "rb") as in_file:
+            try:
+                self._map = mmap.mmap(in_file.fileno(), 0,
+                                      access=mmap.ACCESS_READ)
+            except (ValueError, mmap.error):
+                raise ValueError("'{}' is not a saved index.".format(path))
+        try:
+            self._read_header(path)
+        except BaseException:
+            self._map.close()
+            raise
+
+    def _read_header(self, path):
+        if len(self._map) < _HEADER.size:
+            raise ValueError("'{}' is not a saved index.".format(path))
+        (magic, version, self.n, fold_long_vowels, self.doc_count,
+         self.gram_count, posting_count, sequence_length,
+         doc_ids_size) = _HEADER.unpack_from(self._map)
+        if magic != _MAGIC or version != _VERSION:
+            raise ValueError("'{}' is not a saved index.".format(path))
+        self.fold_long_vowels = bool(fold_long_vowels)
+
+        self._grams = _HEADER.size
+        self._gram_offsets = self._grams + 2 * self.n * self.gram_count
+        self._postings = self._gram_offsets + 4 * (self.gram_count + 1)
+        self._doc_offsets = self._postings + 4 * posting_count
+        self._sequences = self._doc_offsets + 4 * (self.doc_count + 1)
+        doc_ids_start = self._sequences + 2 * sequence_length
+        if doc_ids_start + doc_ids_size != len(self._map):
+            raise ValueError("'{}' is truncated.".format(path))
+        self.doc_ids = marshal.loads(
+            self._map[doc_ids_start:doc_ids_start + doc_ids_size])
+        self.numbers = {doc_id: number
+                        for number, doc_id in enumerate(self.doc_ids)}
+
+    def close(self):
+        self._map.close()
+
+    def postings(self, gram):
+        """
+        Return a tuple of the numbers of the documents containing `gram`.
+        """
+        key = (gram + SEPARATOR * self.n)[:self.n]
+        width = 2 * self.n
+        lo, hi = 0, self.gram_count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            start = self._grams + width * mid
+            if self._map[start:start + width].decode("utf-16-le") < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo == self.gram_count:
+            return ()
+        start = self._grams + width * lo
+        if self._map[start:start + width].decode("utf-16-le") != key:
+            return ()
+        first, last = struct.unpack_from(b"<II", self._map,
+                                         self._gram_offsets + 4 * lo)
+        return struct.unpack_from(b"<{}I".format(last - first), self._map,
+                                  self._postings + 4 * first)
+
+    def sequence(self, number):
+        """
+        Return the lemma sequence of the document numbered `number`.
+        """
+        first, last = struct.unpack_from(b"<II", self._map,
+                                         self._doc_offsets + 4 * number)
+        return self._map[self._sequences + 2 * first:
+                         self._sequences + 2 * last].decode("utf-16-le")
+
+
+def _grams(sequence, n):
+    """
+    Return the set of n-grams of 1 to `n` lemmas in the lemma sequence
+    `sequence`.
+    """
+    grams = set()
+    for run in sequence.split(SEPARATOR):
+        length = len(run)
+        for size in xrange(1, n + 1):
+            for start in xrange(length - size + 1):
+                grams.add(run[start:start + size])
+    return grams
+
+
+def _query_grams(run, n):
+    """
+    Return the n-grams to look up for the run of lemmas `run`: all of its
+    `n`-lemma n-grams, or `run` itself if it is shorter.
+    """
+    if len(run) <= n:
+        return [run]
+    return [run[start:start + n] for start in xrange(len(run) - n + 1)]
+
+
+def _intersect(postings):
+    """
+    Return the intersection of the iterables in `postings` as a set.
+    """
+    result = None
+    for doc_ids in postings:
+        if result is None:
+            result = set(doc_ids)
+        else:
+            result.intersection_update(doc_ids)
+        if not result:
+            break
+    return result or set()
+
+
+def _little_endian(values):
+    """
+    Return the bytes of the array `values` in little-endian order.
+    """
+    if sys.byteorder != "little":
+        values = array.array(values.typecode, values)
+        values.byteswap()
+    return values.tostring()
@@ -0,0 +1,325 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+
+"""
+lemmas.py
+
+Compact form of the internal representation: an array of lemma IDs, which
+are indices into defs.LEMMAS, with runs of unconverted text kept aside.
+
+Unlike the uppercase string form, unconverted text can never be mistaken for
+a lemma, and emitting needs no second tokenization.
+"""
+
+import array
+import collections
+
+import defs
+import mapping
+
+
+LEMMA_IDS = {lemma: lemma_id for lemma_id, lemma in enumerate(defs.LEMMAS)}
+
+# ID standing for the next run of unconverted text
+PASSTHROUGH = 0xFFFF
+
+
+class LemmaString(object):
+    """
+    A sequence of lemma IDs, `ids`, where each PASSTHROUGH ID stands for the
+    next string in `runs`.
+    """
+
+    __slots__ = ("ids", "runs")
+
+    def __init__(self, ids=None, runs=None):
+        self.ids = ids if ids is not None else array.array("H")
+        self.runs = runs if runs is not None else []
+
+    def __eq__(self, other):
+        return (isinstance(other, LemmaString) and
+                self.ids == other.ids and self.runs == other.runs)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __repr__(self):
+        return "LemmaString({!r})".format(list(self))
+
+    def __unicode__(self):
+        """
+        Return the uppercase string form, e.g. "KYA".
+        """
+        return "".join(self)
+
+    def __iter__(self):
+        """
+        Iterate over the lemmas, and runs of unconverted text, as strings.
+        """
+        runs = iter(self.runs)
+        for lemma_id in self.ids:
+            if lemma_id == PASSTHROUGH:
+                yield next(runs)
+            else:
+                yield defs.LEMMAS[lemma_id]
+
+
+class LemmaCounts(object):
+    """
+    Counts of lemmas, keyed by their entries in defs.LEMMAS, and of
+    unconverted characters, as collections.Counters.
+
+    Counts of separate parts of a corpus add up to the counts of the whole.
+    """
+
+    def __init__(self, lemmas=None, unconverted=None):
+        self.lemmas = collections.Counter(lemmas or {})
+        self.unconverted = collections.Counter(unconverted or {})
+
+    def __eq__(self, other):
+        return (isinstance(other, LemmaCounts) and
+                self.lemmas == other.lemmas and
+                self.unconverted == other.unconverted)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __add__(self, other):
+        total = LemmaCounts(self.lemmas, self.unconverted)
+        total.update(other)
+        return total
+
+    def __repr__(self):
+        return "LemmaCounts({!r}, {!r})".format(dict(self.lemmas),
+                                               dict(self.unconverted))
+
+    def update(self, other):
+        """
+        Add the counts of the LemmaCounts `other` to these.
+        """
+        self.lemmas.update(other.lemmas)
+        self.unconverted.update(other.unconverted)
+
+    def total(self):
+        """
+        Return the total number of lemmas counted.
+        """
+        return sum(self.lemmas.itervalues())
+
+
+def tokenize(underlying):
+    """
+    Return a tuple of the IDs of the lemmas making up the string `underlying`.
+
+    Raises ValueError if `underlying` is not made of whole lemmas.
+    """
+    ids = []
+    pos = 0
+    while pos < len(underlying):
+        pos, lemma_id = mapping._longest_match(_LEMMA_TRIE, underlying, pos)
+        if lemma_id is None:
+            raise ValueError("'{}' is not a sequence of lemmas.".format(underlying))
+        ids.append(lemma_id)
+    return tuple(ids)
+
+
+class LemmaCodec(object):
+    """
+    Converts between a format's surface strings and LemmaStrings, using
+    tables compiled from the format's Mapping. Never modified once built.
+    """
+
+    def __init__(self, mapping_):
+        surface_to_ids = {}
+        for surface, underlying in mapping_._surface_to_underlying.iteritems():
+            surface_to_ids[surface] = tokenize(underlying)
+        self._parse_trie = mapping._build_trie(surface_to_ids)
+
+        ids_to_surface = {}
+        for underlying, surface in mapping_._underlying_to_surface.iteritems():
+            ids_to_surface[tokenize(underlying)] = surface
+        if all(len(ids) == 1 for ids in ids_to_surface):
+            # every lemma is spelled on its own: emit is a table lookup
+            self._emit_table = tuple(ids_to_surface.get((lemma_id,), lemma)
+                                     for lemma_id, lemma in enumerate(defs.LEMMAS))
+            self._emit_trie = None
+        else:
+            self._emit_table = tuple(defs.LEMMAS)
+            self._emit_trie = mapping._build_trie(ids_to_surface)
+
+    def overlay(self, mapping_, in_map=None, out_map=None, in_removed=(),
+                out_removed=()):
+        """
+        Return the LemmaCodec of `mapping_`, which is this codec's Mapping
+        overlaid with the given changes (see `mapping.Mapping.overlay`),
+        sharing the parts of this codec's tables the changes leave alone.
+        """
+        if self._emit_trie is None:
+            # lookup tables are small; rebuild them
+            return LemmaCodec(mapping_)
+        overlaid = LemmaCodec.__new__(LemmaCodec)
+        overlaid._parse_trie = mapping._overlay_trie(
+            self._parse_trie,
+            {surface: tokenize(underlying)
+             for surface, underlying in (in_map or {}).iteritems()},
+            in_removed)
+        overlaid._emit_table = self._emit_table
+        overlaid._emit_trie = mapping._overlay_trie(
+            self._emit_trie,
+            {tokenize(underlying): surface
+             for underlying, surface in (out_map or {}).iteritems()},
+            [tokenize(underlying) for underlying in out_removed])
+        return overlaid
+
+    def __getstate__(self):
+        return (self._parse_trie, self._emit_table, self._emit_trie)
+
+    def __setstate__(self, state):
+        self._parse_trie, self._emit_table, self._emit_trie = state
+
+    @classmethod
+    def from_state(cls, state):
+        self = cls.__new__(cls)
+        self.__setstate__(state)
+        return self
+
+    def parse(self, string):
+        """
+        Return `string` converted to a LemmaString.
+        """
+        trie = self._parse_trie
+        ids = array.array("H")
+        extend = ids.extend
+        runs = []
+        length = len(string)
+        run_start = pos = 0
+        while pos < length:
+            node = trie.get(string[pos])
+            if node is None:
+                pos += 1
+                continue
+            end = 0
+            scan = pos + 1
+            while True:
+                if mapping._VALUE in node:
+                    end, value = scan, node[mapping._VALUE]
+                if scan == length:
+                    break
+                node = node.get(string[scan])
+                if node is None:
+                    break
+                scan += 1
+            if end:
+                if run_start < pos:
+                    ids.append(PASSTHROUGH)
+                    runs.append(string[run_start:pos])
+                extend(value)
+                run_start = pos = end
+            else:
+                pos += 1
+        if run_start < length:
+            ids.append(PASSTHROUGH)
+            runs.append(string[run_start:])
+        return LemmaString(ids, runs)
+
+    def count(self, string, counts, final=True):
+        """
+        Add the lemmas `string` parses to, and its unconverted characters, to
+        the LemmaCounts `counts`, without building the converted text.
+
+        Return the number of characters counted. If `final` is False, stop at
+        the first key that might be extended by following text, as
+        `mapping.Mapping.parse_partial` does.
+        """
+        trie = self._parse_trie
+        key_counts = {}
+        unconverted = counts.unconverted
+        length = len(string)
+        pos = 0
+        while pos < length:
+            node = trie.get(string[pos])
+            if node is None:
+                unconverted[string[pos]] += 1
+                pos += 1
+                continue
+            end = 0
+            scan = pos + 1
+            while True:
+                if mapping._VALUE in node:
+                    end, value = scan, node[mapping._VALUE]
+                if scan == length:
+                    if not final and len(node) > (mapping._VALUE in node):
+                        length = pos  # undecided until more text arrives
+                        end = 0
+                    break
+                node = node.get(string[scan])
+                if node is None:
+                    break
+                scan += 1
+            if end:
+                key_counts[value] = key_counts.get(value, 0) + 1
+                pos = end
+            elif pos < length:
+                unconverted[string[pos]] += 1
+                pos += 1
+
+        lemma_counts = counts.lemmas
+        for ids, count in key_counts.iteritems():
+            for lemma_id in ids:
+                lemma_counts[defs.LEMMAS[lemma_id]] += count
+        return length
+
+    def emit(self, lemma_string):
+        """
+        Return the LemmaString `lemma_string` converted to this format.
+
+        Lemmas the format has no spelling for are written as in the
+        uppercase string form.
+        """
+        table = self._emit_table
+        ids = lemma_string.ids
+        if self._emit_trie is None:
+            if not lemma_string.runs:
+                return "".join(map(table.__getitem__, ids))
+            runs = iter(lemma_string.runs)
+            return "".join(next(runs) if lemma_id == PASSTHROUGH else table[lemma_id]
+                           for lemma_id in ids)
+
+        trie = self._emit_trie
+        runs = iter(lemma_string.runs)
+        out = []
+        append = out.append
+        length = len(ids)
+        pos = 0
+        while pos < length:
+            lemma_id = ids[pos]
+            node = trie.get(lemma_id)
+            if node is None:
+                append(next(runs) if lemma_id == PASSTHROUGH else table[lemma_id])
+                pos += 1
+                continue
+            end = 0
+            scan = pos + 1
+            while True:
+                if mapping._VALUE in node:
+                    end, value = scan, node[mapping._VALUE]
+                if scan == length:
+                    break
+                node = node.get(ids[scan])
+                if node is None:
+                    break
+                scan += 1
+            if end:
+                append(value)
+                pos = end
+            else:
+                append(table[lemma_id])
+                pos += 1
+        return "".join(out)
+
+
+_LEMMA_TRIE = mapping._build_trie(LEMMA_IDS)
@@ -2,21 +2,50 @@
 
 from __future__ import unicode_literals
 
+import array
 import re
 
 import util
 
 
+class ConversionError(ValueError):
+    """
+    Raised by conversions with errors="strict" on text that can't be
+    converted: `string[start:end]`.
+    """
+
+    def __init__(self, string, start, end):
+        ValueError.__init__(
+            self, "Can't convert '{}' at position {}.".format(
+                string[start:end], start))
+        self.string = string
+        self.start = start
+        self.end = end
+
+
+# error handling modes of `Mapping.parse` and `Mapping.emit`
+ERROR_MODES = ("strict", "replace", "report")
+
+# substituted for each unconverted character with errors="replace"
+REPLACEMENT_CHARACTER = "\ufffd"
+
+
 class Mapping(object):
     """
     Defines mapping from a surface string to the internal representation.
+
+    A Mapping is never modified once built (`overlay` returns a new one),
+    and conversions keep their working state in locals, so one Mapping can
+    be shared by any number of threads.
     """
 
-    def __init__(self, base_map=None, in_map=None, out_map=None):
+    def __init__(self, base_map=None, in_map=None, out_map=None, unmappable=()):
         """
         base_map -- a dict containing a bidirectional mapping of surface:internal pairs
         in_map -- a dict containing a unidirectional mapping from surface to internal rep
         out_map -- a dict containing a unidirectional mapping to surface from internal rep
+        unmappable -- surface keys whose values are only partly converted, which
+            `parse` with `errors` treats as unconverted text
 
         Contents of `in_map` and `out_map` override `base_map`.
         """
@@ -32,14 +61,57 @@ class Mapping(object):
         self._surface_to_underlying = dict(base_map, **in_map)
         self._underlying_to_surface = dict(inverse_base_map, **out_map)
             
-        self._parse_pattern = re.compile(
-            "$" + \
-            "|".join(sorted(self._surface_to_underlying.keys(), key=len, reverse=True)) + \
-            "^")
-        self._emit_pattern = re.compile(
-            "$" + \
-            "|".join(sorted(self._underlying_to_surface.keys(), key=len, reverse=True)) + \
-            "^")
+        self._parse_trie = _build_trie(self._surface_to_underlying)
+        self._emit_trie = _build_trie(self._underlying_to_surface)
+        self._key_runs = _key_runs_pattern(self._surface_to_underlying)
+        self._unmappable = frozenset(unmappable)
+
+    def overlay(self, in_map=None, out_map=None, in_removed=(), out_removed=()):
+        """
+        Return a Mapping with the entries of `in_map` and `out_map` added to
+        or replacing those of this one, and the keys in `in_removed` and
+        `out_removed` removed.
+
+        The new Mapping shares this one's tables and every part of its tries
+        that the changes leave alone, so it costs memory in proportion to the
+        changes. Lookups are as fast as in a Mapping built from scratch.
+        """
+        in_map = in_map or {}
+        out_map = out_map or {}
+        overlaid = Mapping.__new__(Mapping)
+        overlaid._surface_to_underlying = util.LayeredDict(
+            self._surface_to_underlying, in_map, in_removed)
+        overlaid._underlying_to_surface = util.LayeredDict(
+            self._underlying_to_surface, out_map, out_removed)
+        overlaid._parse_trie = _overlay_trie(self._parse_trie, in_map, in_removed)
+        overlaid._emit_trie = _overlay_trie(self._emit_trie, out_map, out_removed)
+        overlaid._key_runs = _key_runs_pattern(overlaid._surface_to_underlying)
+        overlaid._unmappable = self._unmappable.difference(in_map, in_removed)
+        return overlaid
+
+    def __getstate__(self):
+        """
+        Return the compiled tables as plain data, suitable for `marshal`.
+        """
+        return (dict(self._surface_to_underlying),
+                dict(self._underlying_to_surface),
+                self._parse_trie, self._emit_trie,
+                tuple(self._unmappable))
+
+    def __setstate__(self, state):
+        (self._surface_to_underlying, self._underlying_to_surface,
+         self._parse_trie, self._emit_trie, unmappable) = state
+        self._key_runs = _key_runs_pattern(self._surface_to_underlying)
+        self._unmappable = frozenset(unmappable)
+
+    @classmethod
+    def from_state(cls, state):
+        """
+        Return a Mapping restored from the result of `__getstate__`.
+        """
+        self = cls.__new__(cls)
+        self.__setstate__(state)
+        return self
 
     def __unicode__(self):
         return (
@@ -82,28 +154,512 @@ class Mapping(object):
         """
         Returns True if entire string can be matched by surface format, False otherwise.
         """
-        return re.match(pattern=self._parse_pattern,
-                        string=string)
+        return _matches_fully(self._parse_trie, string)
 
     def match_underlying(self, string):
         """
         Returns True if entire string can be matched by internal format, False otherwise.
         """
-        return re.match(pattern=self._emit_pattern,
-                        string=string)
+        return _matches_fully(self._emit_trie, string)
 
-    def parse(self, string):
+    def parse(self, string, errors=None):
         """
         Return a string (partially) converted to the internal representation.
+
+        Text that can't be converted is copied through, unless `errors` is:
+        "strict" -- raise ConversionError at the first such character
+        "replace" -- write REPLACEMENT_CHARACTER for each such character
+        "report" -- return (converted, spans), where `spans` lists the
+            (start, end) offsets in `string` of the unconverted text
+        Keys whose values are only partly converted (see `compose`) count as
+        unconverted text.
         """
-        return re.sub(pattern=self._parse_pattern,
-                      repl=lambda x: self._surface_to_underlying[x.group(0)],
-                      string=string)
+        if errors is None:
+            return _translate(self._parse_trie, string)
+        return _translate_checked(self._parse_trie, string, errors,
+                                  self._unmappable)
 
-    def emit(self, string):
+    def parse_aligned(self, string):
+        """
+        Return (converted, alignment): `string` converted as `parse` would,
+        and an array.array of four offsets for each key matched, in order:
+        the key's start in `string`, the start of its value in `converted`,
+        and the end of each. Text between keys is copied through, so offsets
+        in it differ by the same amount in both strings.
+        """
+        alignment = array.array("l")
+        return _scan(self._parse_trie, string, True, alignment)[0], alignment
+
+    def emit(self, string, errors=None):
         """
         Return a string (partially) converted to surface representation.
+
+        `errors` is as for `parse`.
         """
-        return re.sub(pattern=self._emit_pattern,
-                      repl=lambda x: self._underlying_to_surface[x.group(0)],
-                      string=string)
+        if errors is None:
+            return _translate(self._emit_trie, string)
+        return _translate_checked(self._emit_trie, string, errors)
+
+    def split_key_runs(self, string):
+        """
+        Return a list of the runs of `string` made of characters that are
+        part of some surface key, at odd indices, and the runs between them,
+        at even indices.
+
+        No key can match across the characters between runs, so the runs can
+        be parsed separately.
+        """
+        return self._key_runs.split(string)
+
+    def parse_mixed(self, string):
+        """
+        Return `string` converted as `parse` would, for text mostly in other
+        scripts: only runs of characters that are part of some surface key
+        are scanned, and the text between them is copied in bulk.
+        """
+        parts = self._key_runs.split(string)
+        trie = self._parse_trie
+        for i in xrange(1, len(parts), 2):
+            parts[i] = _translate(trie, parts[i])
+        return "".join(parts)
+
+    def parse_partial(self, string):
+        """
+        Return (converted, remainder) where `converted` is the internal
+        representation of the longest prefix of `string` whose conversion
+        cannot change when more text is appended, and `remainder` is the rest.
+
+        `remainder` is always shorter than the longest key of the mapping.
+        """
+        out, consumed = _scan(self._parse_trie, string, False)
+        return out, string[consumed:]
+
+
+def compose(first, second):
+    """
+    Return a Mapping from the surface format of `first` directly to the surface
+    format of `second`, equivalent to `second.emit(first.parse(string))`.
+
+    Every surface key of `first` maps to its emitted value. Where `second` has
+    a key spanning the boundary between two values (sokuon, nasal or chouon
+    spellings, say), the output depends on the following key, so the
+    concatenated surface keys are added too, repeating until no key of
+    `second` spans the new boundaries.
+
+    Keys whose values `second` can't spell in full (lemmas it has no
+    spelling for) are marked unmappable, so `parse` with `errors` reports them.
+    Without `errors`, the unspelled lemmas are written in lowercase.
+
+    The resulting Mapping only supports `parse`.
+    """
+    pairs = dict(first._surface_to_underlying)
+    direct = {}
+    unmappable = set()
+
+    def add(surface, underlying):
+        value, spelled = _emit_lowered(second, underlying)
+        direct[surface] = value
+        if not spelled:
+            unmappable.add(surface)
+        return value
+
+    for surface, underlying in pairs.iteritems():
+        add(surface, underlying)
+
+    # tails of emit keys, indexed by the heads that complete them
+    tails_by_head = {}
+    for key in second._underlying_to_surface:
+        for i in xrange(1, len(key)):
+            tails_by_head.setdefault(key[:i], set()).add(key[i:])
+
+    # surface keys indexed by the first character of their value
+    by_initial = {}
+    for surface, underlying in pairs.iteritems():
+        if underlying:
+            by_initial.setdefault(underlying[0], []).append(surface)
+
+    pending = pairs.items()
+    while pending:
+        surface, underlying = pending.pop()
+        tails = set()
+        for i in xrange(len(underlying)):
+            tails.update(tails_by_head.get(underlying[i:], ()))
+        followers = set()
+        for tail in tails:
+            for following in by_initial.get(tail[0], ()):
+                if pairs[following].startswith(tail):
+                    followers.add(following)
+        for following in followers:
+            joined = surface + following
+            joined_underlying = underlying + pairs[following]
+            if joined in direct or first.parse(joined) != joined_underlying:
+                continue
+            value, spelled = _emit_lowered(second, joined_underlying)
+            if value == direct[surface] + direct[following]:
+                continue
+            direct[joined] = value
+            if not spelled:
+                unmappable.add(joined)
+            pending.append((joined, joined_underlying))
+            # longer keys starting with `following` must not be cut short
+            for longer in pairs:
+                if longer != following and longer.startswith(following) \
+                        and surface + longer not in direct:
+                    longer_underlying = first.parse(surface + longer)
+                    add(surface + longer, longer_underlying)
+                    pending.append((surface + longer, longer_underlying))
+
+    return Mapping(in_map=direct, unmappable=unmappable)
+
+
+def _emit_lowered(mapping_, string):
+    """
+    Return (emitted, spelled): `string` emitted by `mapping_` with the text it
+    has no spelling for lowercased, and whether all of it was spelled.
+    """
+    emitted, spans = mapping_.emit(string, "report")
+    if not spans:
+        return emitted, True
+    # no key matched across an unspelled run, so the text between runs
+    #   emits the same on its own
+    parts = []
+    start = 0
+    for span_start, span_end in spans:
+        parts.append(mapping_.emit(string[start:span_start]))
+        parts.append(string[span_start:span_end].lower())
+        start = span_end
+    parts.append(mapping_.emit(string[start:]))
+    return "".join(parts), False
+
+
+#
+# trie engine
+#
+# A trie is a nest of dicts keyed by character. The value for a key ending at
+#   a node is stored in that node under `_VALUE`, which can never collide with
+#   a character.
+#
+
+_VALUE = None
+
+
+def _key_runs_pattern(table):
+    """
+    Return a compiled pattern splitting strings into runs of characters
+    that are part of some key of `table`, as `Mapping.split_key_runs`.
+    """
+    key_chars = sorted(set("".join(table)))
+    if not key_chars:
+        # matches nothing
+        return re.compile("(?!)")
+    return re.compile("([{}]+)".format(
+        "".join(re.escape(char) for char in key_chars)))
+
+
+def _build_trie(table):
+    """
+    Return a trie holding the key:value pairs of `table`.
+    """
+    root = {}
+    for key, value in table.iteritems():
+        node = root
+        for char in key:
+            node = node.setdefault(char, {})
+        node[_VALUE] = value
+    return root
+
+
+def _overlay_trie(trie, changes, removed=()):
+    """
+    Return a trie holding the key:value pairs of `trie`, with those of
+    `changes` added or replacing them and the keys in `removed` removed.
+
+    Only the nodes on the paths of changed keys are copied; the rest are
+    shared with `trie`, which is left unchanged.
+    """
+    root = dict(trie)
+    copied = {id(root)}
+
+    def copy_path(key):
+        # return the copied nodes along `key`, from the root
+        path = [root]
+        node = root
+        for char in key:
+            child = node.get(char)
+            if child is None:
+                child = {}
+            elif id(child) not in copied:
+                child = dict(child)
+            else:
+                path.append(child)
+                node = child
+                continue
+            copied.add(id(child))
+            node[char] = child
+            path.append(child)
+            node = child
+        return path
+
+    for key in removed:
+        node = trie
+        for char in key:
+            node = node.get(char)
+            if node is None:
+                break
+        if node is None or _VALUE not in node:
+            continue
+        path = copy_path(key)
+        del path[-1][_VALUE]
+        # prune nodes left empty, so no key seems to continue through them
+        for i in xrange(len(key), 0, -1):
+            if path[i]:
+                break
+            del path[i - 1][key[i - 1]]
+    for key, value in changes.iteritems():
+        copy_path(key)[-1][_VALUE] = value
+    return root
+
+
+def _longest_match(trie, string, start):
+    """
+    Return (end, value) for the longest key of `trie` found at `start` in
+    `string`, or (start, None) if there is none.
+    """
+    end, value = start, None
+    node = trie
+    for pos in xrange(start, len(string)):
+        node = node.get(string[pos])
+        if node is None:
+            break
+        if _VALUE in node:
+            end, value = pos + 1, node[_VALUE]
+    return end, value
+
+
+def _translate(trie, string):
+    """
+    Return `string` with every longest match of a key of `trie` replaced by
+    its value, scanning left to right in a single pass.
+
+    Unmatched characters are copied through unchanged, in runs.
+    """
+    return _scan(trie, string, True)[0]
+
+
+def _translate_checked(trie, string, errors, unmappable=()):
+    """
+    Translate `string` as `_translate` does, handling unconverted text as
+    described in `Mapping.parse`, in the same single pass. Matches of the
+    keys in `unmappable` are handled as unconverted text.
+    """
+    if errors not in ERROR_MODES:
+        raise ValueError("errors must be one of: {}."
+                         " Got '{}' instead.".format(ERROR_MODES, errors))
+    out = []
+    append = out.append
+    spans = []
+    length = len(string)
+    run_start = pos = 0
+    while pos < length:
+        node = trie.get(string[pos])
+        end = 0
+        scan = pos + 1
+        while node is not None:
+            if _VALUE in node:
+                end, value = scan, node[_VALUE]
+            if scan == length:
+                break
+            node = node.get(string[scan])
+            scan += 1
+        if end and unmappable and string[pos:end] in unmappable:
+            if errors == "strict":
+                raise ConversionError(string, pos, end)
+            # part of the unconverted run
+            append(REPLACEMENT_CHARACTER * (end - pos) if errors == "replace"
+                   else value)
+            pos = end
+        elif end:
+            if run_start < pos:
+                spans.append((run_start, pos))
+            append(value)
+            run_start = pos = end
+        else:
+            if run_start == pos and errors == "strict":
+                raise ConversionError(string, pos, pos + 1)
+            append(REPLACEMENT_CHARACTER if errors == "replace" else string[pos])
+            pos += 1
+    if run_start < length:
+        spans.append((run_start, length))
+    if errors == "report":
+        return "".join(out), spans
+    return "".join(out)
+
+
+def _scan(trie, string, final, alignment=None):
+    """
+    Translate `string` as `_translate` does, returning the output and the
+    number of characters of `string` consumed.
+
+    If `final` is False, stop at the first key that might be extended by
+    characters following `string`, leaving the rest unconsumed. If
+    `alignment` is given, the offsets of each match described in
+    `Mapping.parse_aligned` are appended to it.
+    """
+    out = []
+    append = out.append
+    length = len(string)
+    run_start = pos = 0
+    # length of the output up to `run_start`, kept for `alignment`
+    out_pos = 0
+    while pos < length:
+        node = trie.get(string[pos])
+        if node is None:
+            pos += 1
+            continue
+        end = 0
+        scan = pos + 1
+        while True:
+            if _VALUE in node:
+                end, value = scan, node[_VALUE]
+            if scan == length:
+                if not final and len(node) > (_VALUE in node):
+                    # undecided until more input arrives
+                    if run_start < pos:
+                        append(string[run_start:pos])
+                    return "".join(out), pos
+                break
+            node = node.get(string[scan])
+            if node is None:
+                break
+            scan += 1
+        if end:
+            if run_start < pos:
+                append(string[run_start:pos])
+            append(value)
+            if alignment is not None:
+                out_start = out_pos + pos - run_start
+                out_pos = out_start + len(value)
+                alignment.extend((pos, out_start, end, out_pos))
+            run_start = pos = end
+        else:
+            pos += 1
+    if run_start < length:
+        append(string[run_start:])
+    return "".join(out), length
+
+
+def _build_byte_trie(table):
+    """
+    Return a trie holding the key:value pairs of `table` encoded as UTF-8,
+    keyed by the encoding of each character.
+    """
+    root = {}
+    for key, value in table.iteritems():
+        node = root
+        for char in key:
+            node = node.setdefault(char.encode("utf-8"), {})
+        node[_VALUE] = value.encode("utf-8")
+    return root
+
+
+# length of a UTF-8 sequence, by its first byte
+_UTF8_LENGTHS = {chr(byte): 1 if byte < 0xC0 else 2 if byte < 0xE0 else
+                            3 if byte < 0xF0 else 4
+                 for byte in xrange(256)}
+
+
+def _translate_bytes(trie, data, write, chunk_size):
+    """
+    Translate the UTF-8 encoded `data` with a trie from `_build_byte_trie`,
+    as `_translate` would translate the decoded text, passing the encoded
+    output to `write`.
+
+    `data` may be a str, bytearray, memoryview or mmap. It is read in windows
+    of `chunk_size` bytes, so neither it nor the output is ever held whole.
+    """
+    if isinstance(data, memoryview):
+        cut = lambda start, end: data[start:end].tobytes()
+    elif isinstance(data, bytearray):
+        cut = buffer(data).__getslice__
+    else:
+        cut = lambda start, end: data[start:end]
+
+    length = len(data)
+    pending = b""
+    start = 0
+    while start < length:
+        window = pending + cut(start, start + chunk_size)
+        start += chunk_size
+        out, consumed = _scan_bytes(trie, window, start >= length)
+        write(out)
+        pending = window[consumed:]
+    if pending:
+        write(_scan_bytes(trie, pending, True)[0])
+
+
+def _scan_bytes(trie, data, final):
+    """
+    Translate the str `data` with a trie from `_build_byte_trie`, returning
+    the output and the number of bytes consumed, as `_scan` does.
+
+    If `final` is False, also stop at a character cut off by the end of
+    `data`.
+    """
+    out = []
+    append = out.append
+    lengths = _UTF8_LENGTHS
+    length = len(data)
+    run_start = pos = 0
+    while pos < length:
+        size = lengths[data[pos]]
+        node = trie.get(data[pos:pos + size])
+        if node is None:
+            if pos + size > length and not final:
+                break
+            pos += size
+            continue
+        end = 0
+        scan = pos + size
+        while True:
+            if _VALUE in node:
+                end, value = scan, node[_VALUE]
+            if scan == length:
+                if not final and len(node) > (_VALUE in node):
+                    # undecided until more input arrives
+                    if run_start < pos:
+                        append(data[run_start:pos])
+                    return b"".join(out), pos
+                break
+            size = lengths[data[scan]]
+            if scan + size > length and not final:
+                if run_start < pos:
+                    append(data[run_start:pos])
+                return b"".join(out), pos
+            node = node.get(data[scan:scan + size])
+            if node is None:
+                break
+            scan += size
+        if end:
+            if run_start < pos:
+                append(data[run_start:pos])
+            append(value)
+            run_start = pos = end
+        else:
+            pos += lengths[data[pos]]
+    if pos > length or final:
+        pos = length
+    if run_start < pos:
+        append(data[run_start:pos])
+    return b"".join(out), pos
+
+
+def _matches_fully(trie, string):
+    """
+    Return True if longest-match segmentation consumes all of `string`.
+    """
+    pos = 0
+    while pos < len(string):
+        pos, value = _longest_match(trie, string, pos)
+        if value is None:
+            return False
+    return True
@@ -0,0 +1,348 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+from __future__ import print_function
+from __future__ import division
+
+"""
+server.py
+
+Conversion server for programs that can't import romajitool. Tables stay
+compiled between requests, and requests from all clients are converted
+together in batches.
+
+    python -m romajitool.server --port 8765
+    python -m romajitool.server --socket /tmp/romajitool.sock
+
+Each request and response is a JSON object on its own line. The request
+
+    {"id": 1, "text": "しんぶん", "from": "hiragana", "to": "hepburn",
+     "in_opts": [], "out_opts": ["circumflex"]}
+
+is answered by {"id": 1, "text": "shinbun"}, or {"id": 1, "error": "..."}
+if it fails. "id" is optional and echoed back, and options default to none.
+Clients may send many requests without waiting; responses on a connection
+come back in request order. {"metrics": true} is answered with the server's
+metrics (see `Batcher.metrics`).
+
+Requests wait in a queue of at most `queue_size` requests, and each
+connection has at most PIPELINE_DEPTH requests in flight. Clients that send
+faster than the server converts are not read from until there is room.
+"""
+
+import argparse
+import collections
+import json
+import os
+import Queue
+import SocketServer
+import sys
+import threading
+import timeit
+
+import common
+
+
+# requests waiting for the converter, across all connections
+QUEUE_SIZE = 10000
+
+# requests converted per batch, at most
+BATCH_SIZE = 1000
+
+# requests a connection may have in flight before it stops being read
+PIPELINE_DEPTH = 100
+
+# number of recent requests whose latencies give the percentiles in metrics
+LATENCY_WINDOW = 1000
+
+
+class Batcher(object):
+    """
+    Converts queued requests on a single thread, taking everything queued
+    at once as a batch. Requests for the same formats and options in a batch
+    are converted with one call to `common.convert_many`.
+    """
+
+    def __init__(self, queue_size=QUEUE_SIZE, batch_size=BATCH_SIZE):
+        self._queue = Queue.Queue(queue_size)
+        self._batch_size = batch_size
+        self._lock = threading.Lock()
+        self._requests = self._errors = self._batches = 0
+        self._max_depth = 0
+        self._total_latency = self._max_latency = 0.0
+        self._latencies = collections.deque(maxlen=LATENCY_WINDOW)
+        self._thread = threading.Thread(target=self._run,
+                                        name="romajitool-batcher")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def submit(self, request):
+        """
+        Queue the _Request `request`, blocking while the queue is full.
+        """
+        request.queued = timeit.default_timer()
+        self._queue.put(request)
+
+    def stop(self):
+        """
+        Convert the requests already queued, then stop.
+        """
+        self._queue.put(None)
+        self._thread.join()
+
+    def metrics(self):
+        """
+        Return a dict of request, error and batch counts, current and
+        maximum queue depth, and latencies in seconds from queueing to
+        conversion: the mean and maximum over all requests, and percentiles
+        over the last LATENCY_WINDOW.
+        """
+        with self._lock:
+            latencies = sorted(self._latencies)
+            return {"requests": self._requests,
+                    "errors": self._errors,
+                    "batches": self._batches,
+                    "mean_batch_size": (self._requests / self._batches
+                                        if self._batches else 0.0),
+                    "queue_depth": self._queue.qsize(),
+                    "max_queue_depth": self._max_depth,
+                    "mean_latency": (self._total_latency / self._requests
+                                     if self._requests else 0.0),
+                    "max_latency": self._max_latency,
+                    "p50_latency": _percentile(latencies, 0.50),
+                    "p99_latency": _percentile(latencies, 0.99)}
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            depth = self._queue.qsize() + 1
+            while len(batch) < self._batch_size and batch[-1] is not None:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except Queue.Empty:
+                    break
+            stopping = batch[-1] is None
+            if stopping:
+                batch.pop()
+            if batch:
+                self._convert(batch, depth)
+            if stopping:
+                return
+
+    def _convert(self, batch, depth):
+        try:
+            by_key = collections.OrderedDict()
+            for request in batch:
+                by_key.setdefault(request.key, []).append(request)
+            errors = 0
+            for key, requests in by_key.iteritems():
+                try:
+                    results = list(common.convert_many(
+                        [request.text for request in requests], *key))
+                except ValueError as e:
+                    error = "{}".format(e)
+                except Exception as e:
+                    # a bug, but it must not stop the only converting thread
+                    error = "Conversion failed: {}: {}".format(
+                        type(e).__name__, e)
+                else:
+                    for request, result in zip(requests, results):
+                        request.result = result
+                    continue
+                errors += len(requests)
+                for request in requests:
+                    request.error = error
+
+            now = timeit.default_timer()
+            with self._lock:
+                self._requests += len(batch)
+                self._errors += errors
+                self._batches += 1
+                self._max_depth = max(self._max_depth, depth)
+                for request in batch:
+                    latency = now - request.queued
+                    self._total_latency += latency
+                    self._max_latency = max(self._max_latency, latency)
+                    self._latencies.append(latency)
+        finally:
+            # a request left undone would block its client forever
+            for request in batch:
+                request.done.set()
+
+
+class _Request(object):
+    """
+    A request from a client, with its response once `done` is set.
+    """
+
+    __slots__ = ("id", "key", "text", "result", "error", "queued", "done")
+
+    def __init__(self):
+        self.id = self.key = self.text = None
+        self.result = self.error = None
+        self.queued = None
+        self.done = threading.Event()
+
+    def response(self):
+        response = {"id": self.id} if self.id is not None else {}
+        if self.error is not None:
+            response["error"] = self.error
+        elif self.text is None:
+            response["metrics"] = self.result
+        else:
+            response["text"] = self.result
+        return response
+
+
+class _Handler(SocketServer.StreamRequestHandler):
+    """
+    Reads a connection's requests and queues them, while a second thread
+    writes the responses in order.
+    """
+
+    def handle(self):
+        in_flight = Queue.Queue(PIPELINE_DEPTH)
+        writer = threading.Thread(target=self._write_responses,
+                                  args=(in_flight,))
+        writer.daemon = True
+        writer.start()
+        try:
+            for line in self.rfile:
+                if not line.strip():
+                    continue
+                request = self._read_request(line)
+                in_flight.put(request)
+                if not request.done.is_set():
+                    self.server.batcher.submit(request)
+        finally:
+            in_flight.put(None)
+            writer.join()
+
+    def _read_request(self, line):
+        """
+        Return a _Request for the JSON line `line`. Requests that need no
+        conversion come back already done.
+        """
+        request = _Request()
+        try:
+            fields = json.loads(line.decode("utf-8"))
+            if not isinstance(fields, dict):
+                raise ValueError("Request must be a JSON object.")
+            request.id = fields.get("id")
+            if fields.get("metrics"):
+                request.result = self.server.batcher.metrics()
+                request.done.set()
+                return request
+            text, in_fmt, out_fmt = fields["text"], fields["from"], fields["to"]
+            in_opts = fields.get("in_opts") or []
+            out_opts = fields.get("out_opts") or []
+            if not all(isinstance(value, unicode)
+                       for value in (text, in_fmt, out_fmt)):
+                raise ValueError("'text', 'from' and 'to' must be strings.")
+            if not all(isinstance(opts, list) and
+                       all(isinstance(opt, unicode) for opt in opts)
+                       for opts in (in_opts, out_opts)):
+                raise ValueError("Options must be lists of strings.")
+            request.text = text
+            request.key = (in_fmt, out_fmt, tuple(in_opts), tuple(out_opts))
+        except KeyError as e:
+            request.error = "Missing field {}.".format(e)
+            request.done.set()
+        except ValueError as e:
+            request.error = "{}".format(e)
+            request.done.set()
+        return request
+
+    def _write_responses(self, in_flight):
+        while True:
+            request = in_flight.get()
+            if request is None:
+                return
+            request.done.wait()
+            response = json.dumps(request.response(), ensure_ascii=False)
+            try:
+                self.wfile.write(response.encode("utf-8") + b"\n")
+                self.wfile.flush()
+            except (IOError, OSError):
+                # client went away; keep draining so the reader isn't blocked
+                pass
+
+
+class TCPServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+    """
+    Conversion server on a TCP socket at `address`, a (host, port) pair,
+    queueing requests on the Batcher `batcher`.
+    """
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, batcher):
+        self.batcher = batcher
+        SocketServer.TCPServer.__init__(self, address, _Handler)
+
+
+class UnixServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    """
+    Conversion server on a Unix socket at the path `address`, queueing
+    requests on the Batcher `batcher`.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, address, batcher):
+        self.batcher = batcher
+        SocketServer.UnixStreamServer.__init__(self, address, _Handler)
+
+
+def main(argv=None):
+    """
+    Run the server with the arguments `argv` (defaults to sys.argv[1:])
+    until interrupted.
+    """
+    parser = argparse.ArgumentParser(
+        prog="python -m romajitool.server",
+        description="Serve conversions over a socket as line-delimited JSON.")
+    address = parser.add_mutually_exclusive_group(required=True)
+    address.add_argument("--port", type=int,
+                         help="listen on this TCP port")
+    address.add_argument("--socket", metavar="PATH",
+                         help="listen on a Unix socket at PATH")
+    parser.add_argument("--host", default="127.0.0.1",
+                        help="address to listen on with --port"
+                             " (default: 127.0.0.1)")
+    parser.add_argument("--queue-size", type=int, default=QUEUE_SIZE,
+                        metavar="N", help="requests queued at most")
+    args = parser.parse_args(argv)
+
+    batcher = Batcher(args.queue_size)
+    if args.socket is not None:
+        if os.path.exists(args.socket):
+            os.unlink(args.socket)
+        server = UnixServer(args.socket, batcher)
+    else:
+        server = TCPServer((args.host, args.port), batcher)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        batcher.stop()
+        if args.socket is not None:
+            os.unlink(args.socket)
+    return 0
+
+
+def _percentile(values, fraction):
+    """
+    Return the value at `fraction` of the sorted list `values`, or 0.0.
+    """
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+
+"""
+stats.py
+
+Opt-in counters and timers for conversion, showing where the time goes and
+which tables do the work.
+
+Nothing is recorded unless `enabled` is set; until then conversion pays for
+a single check of it. Recording costs a second, counting pass over the input,
+which is not included in the timings.
+"""
+
+import collections
+import threading
+
+import defs
+import lemmas
+import mapping
+import textformat
+
+
+_FIELDS = ["calls", "chars_in", "chars_out", "matches", "passthrough",
+           "base", "nasal", "sokuon", "chouon",
+           "load_seconds", "convert_seconds"]
+
+
+class ConvertStats(collections.namedtuple("ConvertStats", _FIELDS)):
+    """
+    Snapshot of conversion statistics.
+
+    calls -- number of strings converted
+    chars_in, chars_out -- characters read and written
+    matches -- number of table keys matched
+    passthrough -- characters copied through unconverted
+    base, nasal, sokuon, chouon -- lemmas matched, by the romaji table that
+        spells them: moras, syllabic n, doubled consonants and long vowels
+    load_seconds -- time spent finding or compiling format pairs
+    convert_seconds -- time spent converting
+    """
+
+    __slots__ = ()
+
+    def merged(self, other):
+        """
+        Return the sum of this snapshot and `other`, e.g. one taken in
+        another process.
+        """
+        return ConvertStats(*[mine + theirs for mine, theirs in zip(self, other)])
+
+
+_TABLE_OF_LEMMA = {defs.LEMMA_NASAL : "nasal",
+                   defs.LEMMA_SOKUON: "sokuon",
+                   defs.LEMMA_CHOUON: "chouon"}
+
+enabled = False
+
+_totals = dict.fromkeys(_FIELDS, 0)
+_totals_lock = threading.Lock()
+
+# lemma counts by table for each surface key matched so far,
+#   keyed by (in_fmt, in_opts)
+_key_tables = {}
+
+
+def snapshot():
+    """
+    Return the statistics recorded so far as a ConvertStats.
+    """
+    with _totals_lock:
+        return ConvertStats(**_totals)
+
+
+def reset():
+    """
+    Set all statistics to zero.
+    """
+    with _totals_lock:
+        for name in _FIELDS:
+            _totals[name] = 0
+
+
+def add(stats):
+    """
+    Add the ConvertStats `stats` to the statistics recorded so far.
+    """
+    with _totals_lock:
+        for name, value in zip(_FIELDS, stats):
+            _totals[name] += value
+
+
+def record_load(seconds):
+    """
+    Record `seconds` spent finding or compiling a format pair outside of
+    a conversion.
+    """
+    with _totals_lock:
+        _totals["load_seconds"] += seconds
+
+
+def record(in_fmt, in_opts, direct, in_str, out_str, load_seconds,
+           convert_seconds):
+    """
+    Record the conversion of `in_str` to `out_str` by the direct Mapping
+    `direct` from `in_fmt` with the options `in_opts`.
+    """
+    key_tables = _key_tables.get((in_fmt, in_opts))
+    if key_tables is None:
+        key_tables = _key_tables.setdefault((in_fmt, in_opts), {})
+    in_format = None
+
+    trie = direct._parse_trie
+    matches = passthrough = 0
+    table_counts = dict.fromkeys(("base", "nasal", "sokuon", "chouon"), 0)
+    pos = 0
+    while pos < len(in_str):
+        end, value = mapping._longest_match(trie, in_str, pos)
+        if value is None:
+            passthrough += 1
+            pos += 1
+            continue
+        matches += 1
+        surface = in_str[pos:end]
+        tables = key_tables.get(surface)
+        if tables is None:
+            if in_format is None:
+                in_format = textformat.get_format(in_fmt).with_options(in_opts)
+            tables = key_tables[surface] = _count_tables(in_format, surface)
+        for table in tables:
+            table_counts[table] += 1
+        pos = end
+
+    with _totals_lock:
+        _totals["calls"] += 1
+        _totals["chars_in"] += len(in_str)
+        _totals["chars_out"] += len(out_str)
+        _totals["matches"] += matches
+        _totals["passthrough"] += passthrough
+        for table, count in table_counts.iteritems():
+            _totals[table] += count
+        _totals["load_seconds"] += load_seconds
+        _totals["convert_seconds"] += convert_seconds
+
+
+def _count_tables(in_format, surface):
+    """
+    Return the tables spelling each lemma of the surface key `surface`.
+    """
+    return tuple(_TABLE_OF_LEMMA.get(defs.LEMMAS[lemma_id], "base")
+                 for lemma_id in in_format.parse_lemmas(surface).ids
+                 if lemma_id != lemmas.PASSTHROUGH)
@@ -2,14 +2,21 @@
 
 from __future__ import unicode_literals
 
-import re
+import threading
+import unicodedata
 
+import cache
 import defs
+import lemmas
 import mapping
+import util
 
 class TextFormat(object):
     """
     Defines mapping from a Kana or romanization format to the internal representation.
+
+    Like its Mapping, a format is never modified once built (`with_options`
+    returns a new one), so formats can be shared between threads.
     """
 
     def __init__(self, name, mapping):
@@ -19,6 +26,7 @@ class TextFormat(object):
         """
         self._name = name
         self._mapping = mapping
+        self._codec = lemmas.LemmaCodec(mapping)
 
     def __unicode__(self):
         return (
@@ -28,6 +36,25 @@ class TextFormat(object):
             .format(unicode(self._name), unicode(self.mapping))
         )
 
+    def __getstate__(self):
+        return (self._name, self._mapping.__getstate__(),
+                self._codec.__getstate__())
+
+    def __setstate__(self, state):
+        name, mapping_state, codec_state = state
+        self._name = name
+        self._mapping = mapping.Mapping.from_state(mapping_state)
+        self._codec = lemmas.LemmaCodec.from_state(codec_state)
+
+    @classmethod
+    def from_state(cls, state):
+        """
+        Return a format restored from the result of `__getstate__`.
+        """
+        self = cls.__new__(cls)
+        self.__setstate__(state)
+        return self
+
     @property
     def name(self):
         return self._name
@@ -50,6 +77,45 @@ class TextFormat(object):
         """
         return self._mapping.emit(string)
 
+    def parse_mixed(self, string):
+        """
+        Return a string converted to the internal representation, as `parse`
+        would, for text mostly in other scripts. Text in no key of the
+        format is copied in bulk rather than scanned.
+        """
+        return self._mapping.parse_mixed(string)
+
+    def parse_lemmas(self, string):
+        """
+        Return a string converted to the internal representation, as a
+        compact lemmas.LemmaString of lemma IDs.
+        """
+        return self._codec.parse(string)
+
+    def count_lemmas(self, string, counts, final=True):
+        """
+        Add the lemmas in a string, and its unconverted characters, to the
+        lemmas.LemmaCounts `counts`. See `lemmas.LemmaCodec.count`.
+        """
+        return self._codec.count(string, counts, final)
+
+    def emit_lemmas(self, lemma_string):
+        """
+        Return a lemmas.LemmaString converted to this format.
+        """
+        return self._codec.emit(lemma_string)
+
+    def with_options(self, opts):
+        """
+        Return a copy of this format with the options in `opts` applied.
+
+        Kana formats take no options.
+        """
+        if opts:
+            raise ValueError("Format '{}' takes no options."
+                             " Got {} instead.".format(self._name, list(opts)))
+        return self
+
 
 class RomajiFormat(TextFormat):
     """
@@ -58,7 +124,7 @@ class RomajiFormat(TextFormat):
     Handles sokuon, etc.
     """
 
-    def __init__(self, name, base, nasal, sokuon, chouon):
+    def __init__(self, name, base, nasal, sokuon, chouon, parent=None):
         """
         Build format from the given lists of Mappings.
 
@@ -68,12 +134,93 @@ class RomajiFormat(TextFormat):
         nasal -- nasal mora with preceding consonants
         sokuon -- sokuon moras with proceding consonants
         chouon -- chou-on mark with preceding vowels
+
+        The four mappings are fused into a single Mapping whose keys are every
+        base mora, optionally lengthened by chouon and then prefixed by sokuon
+        or the nasal mora, so parse and emit take one left-to-right scan.
+
+        If `parent` is a RomajiFormat these mappings are a variant of, the
+        fused tables are overlaid on the parent's, sharing whatever is the
+        same, so the variant costs memory in proportion to the differences.
         """
         self._name = name
         self._base_map = base
         self._nasal_map = nasal
         self._sokuon_map = sokuon
         self._chouon_map = chouon
+        in_map = dict(_fuse(base._surface_to_underlying.items(),
+                            nasal._surface_to_underlying.items(),
+                            sokuon._surface_to_underlying.items(),
+                            chouon._surface_to_underlying.items()))
+        out_map = {underlying: surface for surface, underlying in _fuse(
+            _inverse_items(base._underlying_to_surface),
+            _inverse_items(nasal._underlying_to_surface),
+            _inverse_items(sokuon._underlying_to_surface),
+            _inverse_items(chouon._underlying_to_surface))}
+        if parent is None:
+            self._mapping = mapping.Mapping(in_map=in_map, out_map=out_map)
+            self._codec = lemmas.LemmaCodec(self._mapping)
+            self._changes = None
+        else:
+            parent_mapping = parent._mapping
+            in_changes, in_removed = util.diff_dicts(
+                parent_mapping._surface_to_underlying, in_map)
+            out_changes, out_removed = util.diff_dicts(
+                parent_mapping._underlying_to_surface, out_map)
+            self._overlay_parent(parent, (in_changes, out_changes,
+                                          in_removed, out_removed))
+
+    def _overlay_parent(self, parent, changes):
+        self._mapping = parent._mapping.overlay(*changes)
+        self._codec = parent._codec.overlay(self._mapping, *changes)
+        self._changes = changes
+
+    def __getstate__(self):
+        return (self._name,
+                self._mapping.__getstate__(),
+                self._codec.__getstate__(),
+                self._base_map.__getstate__(),
+                self._nasal_map.__getstate__(),
+                self._sokuon_map.__getstate__(),
+                self._chouon_map.__getstate__())
+
+    def __setstate__(self, state):
+        name, mapping_state, codec_state, base, nasal, sokuon, chouon = state
+        self._name = name
+        self._mapping = mapping.Mapping.from_state(mapping_state)
+        self._codec = lemmas.LemmaCodec.from_state(codec_state)
+        self._changes = None
+        self._set_parts(base, nasal, sokuon, chouon)
+
+    def _set_parts(self, base, nasal, sokuon, chouon):
+        self._base_map = mapping.Mapping.from_state(base)
+        self._nasal_map = mapping.Mapping.from_state(nasal)
+        self._sokuon_map = mapping.Mapping.from_state(sokuon)
+        self._chouon_map = mapping.Mapping.from_state(chouon)
+
+    def overlay_state(self):
+        """
+        Return the state of a format built with a `parent`, holding only its
+        changes to the parent's tables, for `from_overlay_state`.
+        """
+        return (self._name, self._changes,
+                self._base_map.__getstate__(),
+                self._nasal_map.__getstate__(),
+                self._sokuon_map.__getstate__(),
+                self._chouon_map.__getstate__())
+
+    @classmethod
+    def from_overlay_state(cls, state, parent):
+        """
+        Return a format restored from the result of `overlay_state`, sharing
+        the tables of `parent` as the original did.
+        """
+        name, changes, base, nasal, sokuon, chouon = state
+        self = cls.__new__(cls)
+        self._name = name
+        self._overlay_parent(parent, changes)
+        self._set_parts(base, nasal, sokuon, chouon)
+        return self
 
     def accepted_lemmas(self):
         return self._base_map.accepted_internal_substrings()
@@ -81,39 +228,268 @@ class RomajiFormat(TextFormat):
     def produced_lemmas(self):
         return self._base_map.produced_internal_substrings()
 
-    def parse(self, string):
+    def with_options(self, opts):
         """
-        Return a string converted to the internal representation.
+        Return a copy of this format with the options in `opts` applied in
+        order. See `ROMAJI_OPTIONS` for the available options.
         """
-        out = string
-        for mapping in (self._chouon_map,
-                        self._sokuon_map,
-                        self._nasal_map,
-                        self._base_map):
-            out = mapping.parse(string)
-        return out
+        if not opts:
+            return self
 
-    def emit(self, string):
-        """
-        Return a string converted to this format.
-        """
-        out = string
-        for mapping in (self._base_map,
-                        self._nasal_map,
-                        self._sokuon_map,
-                        self._chouon_map):
-            out = mapping.emit(string)
-        return out
+        maps = {"base"  : self._base_map,
+                "nasal" : self._nasal_map,
+                "sokuon": self._sokuon_map,
+                "chouon": self._chouon_map}
+        for opt in opts:
+            try:
+                part, table = ROMAJI_OPTIONS[opt]
+            except KeyError:
+                raise ValueError("Options for format '{}' must be among: {}."
+                                 " Got '{}' instead.".format(
+                                     self._name, sorted(ROMAJI_OPTIONS), opt))
+            if part == "chouon":
+                maps[part] = mapping.Mapping(table)
+            elif part == "base_out":
+                maps["base"] = _overlay(maps["base"], out_table=table)
+            else:
+                maps[part] = _overlay(maps[part], table)
+
+        return RomajiFormat(self._name, maps["base"], maps["nasal"],
+                            maps["sokuon"], maps["chouon"], parent=self)
+
+
+# Options accepted by romaji formats, as (part, table) pairs.
+#   "chouon" options replace the long vowel spelling, "base_out" tables are
+#   only used for output, and all others extend the given part of the format.
+ROMAJI_OPTIONS = {
+    # long vowels
+    "macron"        : ("chouon", defs.CHOUON_MACRON),
+    "circumflex"    : ("chouon", defs.CHOUON_CIRCUMFLEX),
+    "double-vowel"  : ("chouon", defs.CHOUON_DOUBLE_VOWEL),
+    "wapuro-vowels" : ("chouon", {}),
+
+    # variants
+    "extended"      : ("base", defs.MORAS_EXTENDED),
+    "archaic-w"     : ("base", defs.ARCHAIC_WAGYO_RETAIN_W),
+    "drop-w"        : ("base_out", defs.ARCHAIC_WAGYO_DROP_W),
+    "traditional"   : ("nasal", defs.NASAL_ALTERNATE_WITH_M),
+    "cch"           : ("sokuon", defs.SOKUON_HEPBURN_WAPURO),
+}
+
+
+def _overlay(mapping_, table=None, out_table=None):
+    """
+    Return `mapping_` overlaid with the bidirectional entries of `table` and
+    the output-only entries of `out_table`.
+    """
+    table = table or {}
+    out_map = {lemma: text for text, lemma in table.iteritems()}
+    for text, lemma in (out_table or {}).iteritems():
+        out_map[lemma] = text
+    return mapping_.overlay(table, out_map)
+
+
+def _inverse_items(table):
+    return [(surface, underlying) for underlying, surface in table.iteritems()]
+
+
+def _fuse(base, nasal, sokuon, chouon):
+    """
+    Return a list of surface, underlying pairs combining lists of base,
+    nasal, sokuon and chouon pairs.
+
+    Combinations are listed after the pairs they are built from, so they
+    take precedence when the list is turned into a dict.
+    """
+    moras = base + list(_lengthen(base, chouon))
+    fused = moras + list(_prefix(nasal, defs.LEMMA_NASAL, moras)) + \
+        list(_prefix(sokuon, defs.LEMMA_SOKUON, moras))
+    return fused
+
+
+def _lengthen(moras, chouon):
+    """
+    Yield moras followed by a chouon pair spelling their final vowel long,
+    e.g. ("ka", "KA") and ("ā", "A-") give ("kā", "KA-").
+    """
+    for long_surface, long_underlying in chouon:
+        vowel = long_underlying[:-len(defs.LEMMA_CHOUON)]
+        for surface, underlying in moras:
+            if underlying.endswith(vowel) and surface.endswith(vowel.lower()):
+                yield (surface[:-len(vowel)] + long_surface,
+                       underlying + defs.LEMMA_CHOUON)
+
+
+def _prefix(pairs, lemma, moras):
+    """
+    Yield moras preceded by a sokuon or nasal pair, which spells `lemma`
+    followed by the consonant the mora begins with,
+    e.g. ("tch", "QCH") and ("chi", "TI") give ("tchi", "QTI").
+    """
+    for pre_surface, pre_underlying in pairs:
+        shared = pre_underlying[len(lemma):].lower()
+        head = pre_surface[:-len(shared)]
+        for surface, underlying in moras:
+            if surface.startswith(shared):
+                yield head + surface, lemma + underlying
 
 
 #
 # init text formats
 #
+# Hiragana and wapuro are cheap and built at import. Other formats are built
+#   on first use by `get_format`, or loaded from the on-disk cache.
+#
 
-WAPURO   = TextFormat("Wapuro", mapping.Mapping())
+WAPURO   = TextFormat("Wapuro",
+                      mapping.Mapping({lemma.lower(): lemma for lemma in defs.LEMMAS}))
 HIRAGANA = TextFormat("Hiragana", mapping.Mapping(defs.HIRAGANA_TAB))
-NIHON    = RomajiFormat("Nihon",
-                        mapping.Mapping(defs.MORAS_NIHON),
+
+
+def _romaji():
+    return RomajiFormat("Romaji",
+                        mapping.Mapping(defs.ROMAJI_MORAS_BASE,
+                                        out_map={lemma: text for text, lemma
+                                                 in defs.ROMAJI_MORAS_BASE_OUTONLY.iteritems()}),
                         mapping.Mapping(defs.NASAL_BASE),
                         mapping.Mapping(defs.SOKUON_BASE),
-                        mapping.Mapping(defs.CHOUON_DOUBLE_VOWEL))
+                        mapping.Mapping())
+
+
+def _nihon(romaji):
+    return RomajiFormat("Nihon",
+                        _overlay(romaji._base_map, defs.MORAS_NIHON),
+                        romaji._nasal_map,
+                        romaji._sokuon_map,
+                        mapping.Mapping(defs.CHOUON_DOUBLE_VOWEL),
+                        parent=romaji)
+
+
+def _kunrei(romaji):
+    return RomajiFormat("Kunrei",
+                        _overlay(romaji._base_map, defs.MORAS_KUNREI,
+                                 defs.MORAS_KUNREI_OUTONLY),
+                        romaji._nasal_map,
+                        romaji._sokuon_map,
+                        mapping.Mapping(defs.CHOUON_CIRCUMFLEX),
+                        parent=romaji)
+
+
+def _hepburn(romaji):
+    return RomajiFormat("Hepburn",
+                        _overlay(romaji._base_map, defs.MORAS_HEPBURN,
+                                 defs.MORAS_HEPBURN_OUTONLY),
+                        _overlay(romaji._nasal_map, defs.NASAL_EXTENDED),
+                        _overlay(romaji._sokuon_map, defs.SOKUON_HEPBURN),
+                        mapping.Mapping(defs.CHOUON_MACRON),
+                        parent=romaji)
+
+
+def _katakana():
+    return TextFormat("Katakana", mapping.Mapping(_katakana_table()))
+
+
+def _halfwidth():
+    halfwidth = _halfwidth_forms()
+    table = {}
+    for text, lemma in _katakana_table().iteritems():
+        if all(char in halfwidth for char in text):
+            table["".join(halfwidth[char] for char in text)] = lemma
+    return TextFormat("Half-width Katakana", mapping.Mapping(table))
+
+
+def _katakana_table():
+    return {text.translate(defs.HIRAGANA_TO_KATAKANA): lemma
+            for text, lemma in defs.HIRAGANA_TAB.iteritems()}
+
+
+def _halfwidth_forms():
+    """
+    Return a dict of full-width katakana to their half-width spellings.
+
+    Voiced and semi-voiced kana are spelled with a separate (han)dakuten mark,
+    so they take two half-width code points.
+    """
+    forms = {}
+    for code in xrange(ord("ｦ"), ord("ﾝ") + 1):
+        char = unichr(code)
+        forms[unicodedata.normalize("NFKC", char)] = char
+        for mark in "ﾞﾟ":
+            combined = unicodedata.normalize("NFKC", char + mark)
+            if len(combined) == 1:
+                forms[combined] = char + mark
+    return forms
+
+
+# formats built on first use, as name: (class, builder)
+#   "romaji" holds the tables the romanizations share; it is not offered as
+#   a format of its own
+_BUILDERS = {"romaji"    : (RomajiFormat, _romaji),
+             "nihon"     : (RomajiFormat, _nihon),
+             "kunrei"    : (RomajiFormat, _kunrei),
+             "hepburn"   : (RomajiFormat, _hepburn),
+             "katakana"  : (TextFormat, _katakana),
+             "halfwidth" : (TextFormat, _halfwidth)}
+
+# formats overlaid on another, as name: parent name; their builders take
+#   the parent format
+_PARENTS = {"nihon"   : "romaji",
+            "kunrei"  : "romaji",
+            "hepburn" : "romaji"}
+
+FORMAT_NAMES = ("hiragana", "katakana", "halfwidth", "wapuro",
+                "nihon", "kunrei", "hepburn")
+
+_formats = {"hiragana" : HIRAGANA,
+            "wapuro"   : WAPURO}
+_formats_lock = threading.Lock()
+
+
+def format_options(name):
+    """
+    Return the names of the options the format called `name` takes, without
+    building it.
+
+    Raises KeyError if there is no such format.
+    """
+    if name not in FORMAT_NAMES:
+        raise KeyError(name)
+    if name in _BUILDERS and _BUILDERS[name][0] is RomajiFormat:
+        return ROMAJI_OPTIONS
+    return ()
+
+
+def get_format(name):
+    """
+    Return the format called `name`, building it on first use.
+
+    Raises KeyError if there is no such format.
+    """
+    try:
+        return _formats[name]
+    except KeyError:
+        pass
+    cls, builder = _BUILDERS[name]
+    # before taking the lock, which isn't reentrant
+    parent = get_format(_PARENTS[name]) if name in _PARENTS else None
+    with _formats_lock:
+        if name not in _formats:
+            fmt = None
+            state = cache.load(("format", name))
+            if state is not None:
+                try:
+                    if parent is None:
+                        fmt = cls.from_state(state)
+                    else:
+                        fmt = cls.from_overlay_state(state, parent)
+                except (ValueError, TypeError):
+                    fmt = None
+            if fmt is None:
+                if parent is None:
+                    fmt = builder()
+                    cache.save(("format", name), fmt.__getstate__())
+                else:
+                    fmt = builder(parent)
+                    cache.save(("format", name), fmt.overlay_state())
+            _formats[name] = fmt
+    return _formats[name]
@@ -2,7 +2,9 @@
 
 from __future__ import unicode_literals
 
+import collections
 import re
+import threading
 
 
 def read_table(tablestr):
@@ -33,4 +35,205 @@ def join_maps_at_shared_char(prefixmap, suffixmap):
                 yield (comb_surface, comb_underlying) 
 
 def join_at_shared_char(s1, s2):
-    return "".join((s1[:-1], s2[1:])) if s1[-1] == s2[0] else None
\ No newline at end of file
+    return "".join((s1[:-1], s2[1:])) if s1[-1] == s2[0] else None
+
+
+CacheInfo = collections.namedtuple(
+    "CacheInfo", ["hits", "misses", "evictions", "maxsize", "currsize"])
+
+
+class LRUCache(object):
+    """
+    Mapping of at most `maxsize` items that discards the least recently used
+    item when full, counting hits, misses and evictions. Safe to share
+    between threads.
+    """
+
+    def __init__(self, maxsize):
+        self._maxsize = maxsize
+        self._items = collections.OrderedDict()
+        self._hits = self._misses = self._evictions = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._items)
+
+    def __contains__(self, key):
+        return key in self._items
+
+    def get(self, key, default=None):
+        """
+        Return the value for `key`, marking it most recently used,
+        or `default` if it is not cached.
+        """
+        with self._lock:
+            try:
+                value = self._items.pop(key)
+            except KeyError:
+                self._misses += 1
+                return default
+            self._items[key] = value
+            self._hits += 1
+            return value
+
+    def put(self, key, value):
+        """
+        Cache `value` under `key`, evicting the least recently used item if full.
+        """
+        with self._lock:
+            self._items.pop(key, None)
+            self._items[key] = value
+            if len(self._items) > self._maxsize:
+                self._items.popitem(last=False)
+                self._evictions += 1
+
+    def clear(self):
+        """
+        Remove all items and reset the counters.
+        """
+        with self._lock:
+            self._items.clear()
+            self._hits = self._misses = self._evictions = 0
+
+    def info(self):
+        """
+        Return a CacheInfo of the counters and current size.
+        """
+        with self._lock:
+            return CacheInfo(self._hits, self._misses, self._evictions,
+                             self._maxsize, len(self._items))
+
+
+class GenerationalCache(object):
+    """
+    Cache of at most `maxsize` items approximating LRU with two generations,
+    for values too cheap to compute to afford LRUCache's bookkeeping: a hit
+    costs one or two dict lookups.
+
+    Items are added to the new generation, and items found in the old one
+    are moved back to the new. When the new generation holds half of
+    `maxsize` items it becomes the old one, and the items still in the
+    previous old generation, which have not been used since, are evicted.
+
+    Safe to share between threads: only starting a generation takes a lock.
+    Items put by one thread while another starts a generation may be lost,
+    which is only a miss, and the counters are approximate under contention.
+    """
+
+    def __init__(self, maxsize):
+        self._maxsize = maxsize
+        self._generation_size = max(1, maxsize // 2)
+        self._new = {}
+        self._old = {}
+        self._hits = self._misses = self._evictions = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._new) + len(self._old)
+
+    def __contains__(self, key):
+        return key in self._new or key in self._old
+
+    def get(self, key, default=None):
+        """
+        Return the value for `key`, or `default` if it is not cached.
+        """
+        value = self._new.get(key, _MISSING)
+        if value is _MISSING:
+            value = self._old.pop(key, _MISSING)
+            if value is _MISSING:
+                self._misses += 1
+                return default
+            self.put(key, value)
+        self._hits += 1
+        return value
+
+    def put(self, key, value):
+        """
+        Cache `value` under `key`, starting a new generation if full.
+        """
+        new = self._new
+        new[key] = value
+        if len(new) >= self._generation_size:
+            with self._lock:
+                if new is self._new:
+                    self._evictions += len(self._old)
+                    self._old = new
+                    self._new = {}
+
+    def clear(self):
+        """
+        Remove all items and reset the counters.
+        """
+        self._new = {}
+        self._old = {}
+        self._hits = self._misses = self._evictions = 0
+
+    def info(self):
+        """
+        Return a CacheInfo of the counters and current size.
+        """
+        return CacheInfo(self._hits, self._misses, self._evictions,
+                         self._maxsize, len(self))
+
+
+# marks a missing item, where None may be a cached value
+_MISSING = object()
+
+
+class LayeredDict(collections.Mapping):
+    """
+    Read-only dict of the items of `base`, with those of `changes` added or
+    replacing them and the keys in `removed` left out. `base` is shared
+    rather than copied, so this costs memory in proportion to the changes.
+    """
+
+    def __init__(self, base, changes, removed=()):
+        self._base = base
+        self._changes = changes
+        self._removed = frozenset(removed)
+        self._len = len(changes) + sum(1 for key in base
+                                       if key not in changes and
+                                       key not in self._removed)
+
+    def __getitem__(self, key):
+        try:
+            return self._changes[key]
+        except KeyError:
+            pass
+        if key in self._removed:
+            raise KeyError(key)
+        return self._base[key]
+
+    def __contains__(self, key):
+        return key in self._changes or (key not in self._removed and
+                                        key in self._base)
+
+    def __iter__(self):
+        for key in self._changes:
+            yield key
+        for key in self._base:
+            if key not in self._changes and key not in self._removed:
+                yield key
+
+    def __len__(self):
+        return self._len
+
+    def iteritems(self):
+        for key in self:
+            yield key, self[key]
+
+    def itervalues(self):
+        for key in self:
+            yield self[key]
+
+
+def diff_dicts(old, new):
+    """
+    Return (changes, removed): the items of dict `new` that are missing from
+    or different in `old`, and the keys of `old` missing from `new`.
+    """
+    changes = {key: value for key, value in new.iteritems()
+               if old.get(key, _MISSING) != value}
+    removed = [key for key in old if key not in new]
+    return changes, removed
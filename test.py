@@ -3,9 +3,34 @@
 
 from __future__ import unicode_literals
 
+import io
+import json
+import mmap
+import os
+import shutil
+import socket
+import sys
+import tempfile
+import threading
 import unittest
 
+# keep test runs out of the user's table cache
+os.environ["ROMAJITOOL_CACHE_DIR"] = ""
+
 from romajitool import *
+from romajitool import cli
+from romajitool import common
+from romajitool import index
+from romajitool import server
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+try:
+    import pandas
+except ImportError:
+    pandas = None
 
 
 class RTTestCase(unittest.TestCase):
@@ -40,5 +65,784 @@ class RTTestCase(unittest.TestCase):
             "hiragana")
 
 
+class MappingTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.mapping = mapping.Mapping({"a": "A", "ab": "B", "abc": "C", "d": "D"})
+
+    def test_longest_match(self):
+        self.assertEqual(self.mapping.parse("abcabad"), "CBAD")
+
+    def test_unmatched_passthrough(self):
+        # "ab" is a prefix of "abc" but "abx" must fall back to "ab"
+        self.assertEqual(self.mapping.parse("xabxd"), "xBxD")
+        self.assertEqual(self.mapping.emit("CxB"), "abcxab")
+
+    def test_match_surface(self):
+        self.assertTrue(self.mapping.match_surface("abcda"))
+        self.assertFalse(self.mapping.match_surface("abcxa"))
+
+    def test_overlay(self):
+        overlaid = self.mapping.overlay({"abd": "E", "x": "X"}, {"E": "abd"},
+                                        in_removed=["abc"])
+        self.assertEqual(overlaid.parse("abcabdx"), "BcEX")
+        self.assertEqual(overlaid.emit("EC"), "abdabc")
+        # the original is unchanged
+        self.assertEqual(self.mapping.parse("abcabdx"), "CBDx")
+        self.assertEqual(dict(overlaid._surface_to_underlying),
+                         {"a": "A", "ab": "B", "abd": "E", "d": "D", "x": "X"})
+        # with "abc" removed, no key continues past "ab"
+        self.assertEqual(self.mapping.overlay(in_removed=["abc"]).parse_partial("ab"),
+                         ("B", ""))
+
+    def test_hiragana_youon(self):
+        self.assertEqual(textformat.HIRAGANA.parse("きゃきい"), "KYAKII")
+
+
+class RomajiFormatTestCase(unittest.TestCase):
+
+    def test_hepburn_emit(self):
+        for hiragana, romaji in [("しんぶん", "shinbun"),
+                                 ("まっちゃ", "matcha"),
+                                 ("きんえん", "kin'en"),
+                                 ("こんや", "kon'ya"),
+                                 ("らーめん", "rāmen"),
+                                 ("ふっふ", "fuffu")]:
+            self.assertEqual(
+                FORMATS["hepburn"].emit(textformat.HIRAGANA.parse(hiragana)),
+                romaji)
+
+    def test_parse_contexts(self):
+        # sokuon, nasal and chouon must all apply within the same string
+        self.assertEqual(FORMATS["hepburn"].parse("kōhī"), "KO-HI-")
+        self.assertEqual(FORMATS["hepburn"].parse("chotto"), "TYOQTO")
+        self.assertEqual(FORMATS["nihon"].parse("sinnen"), "SIN'NEN'")
+        self.assertEqual(FORMATS["kunrei"].parse("kyôtô"), "KYO-TO-")
+
+    def test_options_overlay(self):
+        # variants share the base format's tables, but match a fresh build
+        for opts in (["circumflex"], ["extended", "traditional", "cch"],
+                     ["archaic-w", "drop-w"]):
+            variant = FORMATS["hepburn"].with_options(opts)
+            fresh = textformat.RomajiFormat(
+                "Hepburn", variant._base_map, variant._nasal_map,
+                variant._sokuon_map, variant._chouon_map)
+            self.assertEqual(variant.__getstate__(), fresh.__getstate__())
+
+    def test_shared_tables(self):
+        # the romanizations are overlaid on one base format; where they
+        #   spell a mora and its prefixed forms alike, they share its node
+        romaji = textformat.get_format("romaji")
+        for name in ("kunrei", "hepburn"):
+            trie = FORMATS[name]._mapping._parse_trie
+            self.assertIs(trie["b"]["y"]["o"],
+                          romaji._mapping._parse_trie["b"]["y"]["o"])
+        self.assertNotIn("romaji", FORMATS)
+        self.assertRaises(KeyError, FORMATS.__getitem__, "romaji")
+
+    def test_round_trip(self):
+        for fmt in (FORMATS["nihon"], FORMATS["kunrei"], FORMATS["hepburn"]):
+            for lemmas in ["TOUKYOU", "NIQPON'", "KAN'PAI", "HUQHU", "RA-MEN'"]:
+                self.assertEqual(fmt.parse(fmt.emit(lemmas)), lemmas)
+
+
+class KatakanaFormatTestCase(unittest.TestCase):
+
+    def test_katakana(self):
+        self.assertEqual(convert("ティーシャツ ラーメン", "katakana", "hiragana"),
+                         "てぃーしゃつ らーめん")
+        self.assertEqual(convert("ゔぁいおりん", "hiragana", "katakana"),
+                         "ヴァイオリン")
+
+    def test_halfwidth(self):
+        # voiced kana take two half-width code points
+        self.assertEqual(convert("ｶﾞｯｺｳ ﾊﾟﾝ ｳﾞｧ", "halfwidth", "katakana"),
+                         "ガッコウ パン ヴァ")
+        self.assertEqual(convert("がっこう ぱん", "hiragana", "halfwidth"),
+                         "ｶﾞｯｺｳ ﾊﾟﾝ")
+
+
+class LemmaStringTestCase(unittest.TestCase):
+
+    def test_round_trip(self):
+        lemma_string = textformat.HIRAGANA.parse_lemmas("きょう、 まっちゃ")
+        self.assertEqual(unicode(lemma_string), "KYOU、 MAQTYA")
+        self.assertEqual(lemma_string.runs, ["、 "])
+        self.assertEqual(textformat.HIRAGANA.emit_lemmas(lemma_string),
+                         "きょう、 まっちゃ")
+
+    def test_matches_string_form(self):
+        for fmt in FORMATS.itervalues():
+            for sample in ConvertTestCase.SAMPLES:
+                lemma_string = textformat.HIRAGANA.parse_lemmas(sample)
+                self.assertEqual(fmt.emit_lemmas(lemma_string),
+                                 fmt.emit(textformat.HIRAGANA.parse(sample)))
+
+    def test_passthrough_not_lemmas(self):
+        # the string form would read "KA" back as a lemma
+        lemma_string = FORMATS["hepburn"].parse_lemmas("KA")
+        self.assertEqual(textformat.HIRAGANA.emit_lemmas(lemma_string), "KA")
+
+    def test_tokenize(self):
+        self.assertEqual(lemmas.tokenize("KYA"), (defs.LEMMAS.index("KYA"),))
+        self.assertRaises(ValueError, lemmas.tokenize, "KYx")
+
+
+class ConvertTestCase(unittest.TestCase):
+
+    SAMPLES = ["とうきょうとっきょきょかきょく", "しんぶん", "きんえん", "こんや",
+               "まっちゃ", "らーめん", "っひょー", "ちぢみ", "ふっふ"]
+
+    def test_direct_matches_two_stage(self):
+        for in_fmt, in_format in FORMATS.iteritems():
+            for out_fmt, out_format in FORMATS.iteritems():
+                for sample in self.SAMPLES:
+                    in_str = in_format.emit(textformat.HIRAGANA.parse(sample))
+                    self.assertEqual(
+                        convert(in_str, in_fmt, out_fmt),
+                        out_format.emit(in_format.parse(in_str)),
+                        "{} -> {}: {}".format(in_fmt, out_fmt, in_str))
+
+    def test_wapuro_to_hiragana(self):
+        self.assertEqual(convert("han'ou", "wapuro", "hiragana"), "はんおう")
+        self.assertEqual(convert("texi-", "wapuro", "hiragana"), "てぃー")
+
+    def test_memoize(self):
+        text = "、 ".join(self.SAMPLES * 2) + " きんえん。こんや"
+        for in_fmt, in_format in FORMATS.iteritems():
+            in_str = convert(text, "hiragana", in_fmt)
+            for out_fmt in FORMATS:
+                self.assertEqual(
+                    convert(in_str, in_fmt, out_fmt, memoize=True),
+                    convert(in_str, in_fmt, out_fmt),
+                    "{} -> {}: {}".format(in_fmt, out_fmt, in_str))
+        self.assertGreater(word_cache_info().hits, 0)
+
+    def test_mixed(self):
+        text = ("GET /search?q=しんぶん&lang=ja 200 0.12s まっちゃ-らーめん "
+                "kin'en ｶﾞｯｺｳ \u6f22\u5b57 こんや")
+        for in_fmt, in_format in FORMATS.iteritems():
+            self.assertEqual(in_format.parse_mixed(text), in_format.parse(text))
+            for out_fmt in FORMATS:
+                self.assertEqual(convert(text, in_fmt, out_fmt, mixed=True),
+                                 convert(text, in_fmt, out_fmt),
+                                 "{} -> {}".format(in_fmt, out_fmt))
+
+    def test_convert_many(self):
+        strings = self.SAMPLES + ["", "\ue000あ", "しゃしん"] * 3
+        self.assertEqual(
+            list(convert_many(iter(strings), "hiragana", "hepburn")),
+            [convert(string, "hiragana", "hepburn") for string in strings])
+
+    def test_convert_array(self):
+        nan = float("nan")
+        values = ["しんぶん", None, "まっちゃ", "しんぶん", nan, ""]
+        result = convert_array(values, "hiragana", "hepburn")
+        self.assertEqual(result[:4] + result[5:],
+                         ["shinbun", None, "matcha", "shinbun", ""])
+        self.assertIs(result[4], nan)
+
+    @unittest.skipUnless(numpy, "requires NumPy")
+    def test_convert_array_numpy(self):
+        values = numpy.array([["しんぶん", "まっちゃ"], ["しんぶん", "ら"]])
+        result = convert_array(values, "hiragana", "hepburn")
+        self.assertEqual(result.dtype.kind, "U")
+        self.assertEqual(result.tolist(),
+                         [["shinbun", "matcha"], ["shinbun", "ra"]])
+        values = numpy.array(["しんぶん", None, "しんぶん"], dtype=object)
+        self.assertEqual(convert_array(values, "hiragana", "hepburn").tolist(),
+                         ["shinbun", None, "shinbun"])
+
+    @unittest.skipUnless(pandas, "requires pandas")
+    def test_convert_array_pandas(self):
+        values = pandas.Series(["しんぶん", None, "しんぶん"], index=[3, 1, 2],
+                               name="reading")
+        result = convert_array(values, "hiragana", "hepburn")
+        self.assertEqual(result.name, "reading")
+        self.assertEqual(list(result.index), [3, 1, 2])
+        self.assertEqual(result.dtype, values.dtype)
+        self.assertEqual(result[3], "shinbun")
+        self.assertTrue(pandas.isnull(result[1]))
+
+    def test_convert_stream(self):
+        text = "\n".join(self.SAMPLES) + "ん"
+        for chunk_size in (1, 2, 3, 7, 1000):
+            out_file = io.StringIO()
+            convert_stream(io.StringIO(text), out_file,
+                           "hiragana", "hepburn", chunk_size=chunk_size)
+            self.assertEqual(out_file.getvalue(),
+                             convert(text, "hiragana", "hepburn"))
+
+    def test_alignment(self):
+        in_str = "きょう しんぶん、まっちゃ!"
+        out_str, alignment = convert(in_str, "hiragana", "hepburn",
+                                     with_alignment=True)
+        self.assertEqual(out_str, convert(in_str, "hiragana", "hepburn"))
+        self.assertEqual(len(alignment) % 4, 0)
+        for i in xrange(0, len(alignment), 4):
+            in_start, out_start, in_end, out_end = alignment[i:i + 4]
+            self.assertEqual(
+                convert(in_str[in_start:in_end], "hiragana", "hepburn"),
+                out_str[out_start:out_end])
+
+        self.assertEqual(source_span(alignment, 0, len(out_str)),
+                         (0, len(in_str)))
+        start = out_str.index("shinbun")
+        self.assertEqual(source_span(alignment, start, start + 7), (4, 8))
+        self.assertEqual(source_span(alignment, start + 1, start + 3), (4, 5))
+        self.assertEqual(source_span(alignment, len(out_str) - 1,
+                                     len(out_str)),
+                         (len(in_str) - 1, len(in_str)))
+        self.assertEqual(source_span(convert("abc", "hiragana", "hepburn",
+                                             with_alignment=True)[1], 1, 2),
+                         (1, 2))
+        for option in ({"errors": "strict"}, {"memoize": True},
+                       {"mixed": True}):
+            self.assertRaises(ValueError, convert, in_str, "hiragana",
+                              "hepburn", with_alignment=True, **option)
+
+    def test_spellings(self):
+        self.assertEqual(list(spellings("しゃちょう", "hiragana")),
+                         ["shachou", "shatyou", "syachou", "syatyou"])
+        self.assertEqual(list(spellings("fuji", "hepburn", out_fmts=["kunrei"])),
+                         ["huzi"])
+        self.assertIn("rāmen", list(spellings("らーめん", "hiragana")))
+        # keys some variant only spells in a longer key aren't written raw
+        for in_str in ["うぃ", "てぃ", "でぃ", "ゔゃ", "うぃんどう", "らーめん!"]:
+            results = list(spellings(in_str, "hiragana"))
+            self.assertTrue(results)
+            for spelling in results:
+                self.assertEqual(spelling, spelling.lower())
+                self.assertNotIn("-", spelling)
+                self.assertNotIn("'", spelling.replace("n'", ""))
+        for spelling in spellings("まっちゃ", "hiragana"):
+            self.assertIn("まっちゃ",
+                          [convert(spelling, in_fmt, "hiragana", in_opts=opts)
+                           for in_fmt, opts in (("hepburn", []),
+                                                ("hepburn", ["cch"]),
+                                                ("nihon", []))])
+
+        # lazy: only the spellings asked for are generated
+        many = spellings("しゃちょう" * 50, "hiragana")
+        self.assertEqual(next(many), "shachou" * 50)
+        self.assertEqual(list(spellings("しゃちょう" * 50, "hiragana", limit=3)),
+                         ["shachou" * 49 + ending
+                          for ending in ("shachou", "shatyou", "syachou")])
+        self.assertEqual(list(spellings("しゃちょう", "hiragana",
+                                        keep=lambda prefix: "y" not in prefix)),
+                         ["shachou"])
+
+    def test_count_lemmas(self):
+        counts = count_lemmas("きょう、まっちゃ!", "hiragana")
+        self.assertEqual(counts.lemmas, {"KYO": 1, "U": 1, "MA": 1,
+                                         "Q": 1, "TYA": 1})
+        self.assertEqual(counts.unconverted, {"、": 1, "!": 1})
+        self.assertEqual(counts.total(), 5)
+
+        text = "\n".join(self.SAMPLES) + "ん"
+        whole = count_lemmas(text, "hiragana")
+        for chunk_size in (1, 2, 3, 1000):
+            self.assertEqual(count_lemmas(io.StringIO(text), "hiragana",
+                                          chunk_size=chunk_size),
+                             whole)
+        lines = text.splitlines(True)
+        shards = [count_lemmas("".join(lines[:2]), "hiragana"),
+                  count_lemmas("".join(lines[2:]), "hiragana")]
+        self.assertEqual(shards[0] + shards[1], whole)
+
+    def test_convert_bytes(self):
+        text = "\n".join(self.SAMPLES) + " abc、 ん"
+        expected = convert(text, "hiragana", "hepburn").encode("utf-8")
+        data = text.encode("utf-8")
+        chunk_size = common.CHUNK_SIZE
+        try:
+            # windows that cut characters and keys
+            for common.CHUNK_SIZE in (1, 2, 7, chunk_size):
+                for in_data in (data, bytearray(data), memoryview(data)):
+                    out = bytearray()
+                    convert_bytes(in_data, out, "hiragana", "hepburn")
+                    self.assertEqual(bytes(out), expected)
+        finally:
+            common.CHUNK_SIZE = chunk_size
+
+        with tempfile.TemporaryFile() as in_file:
+            in_file.write(data)
+            in_file.flush()
+            in_map = mmap.mmap(in_file.fileno(), 0, access=mmap.ACCESS_READ)
+            out_file = io.BytesIO()
+            convert_bytes(in_map, out_file, "hiragana", "hepburn")
+            in_map.close()
+        self.assertEqual(out_file.getvalue(), expected)
+
+    def test_parse_partial(self):
+        # "き" could still be the start of "きゃ"
+        self.assertEqual(textformat.HIRAGANA._mapping.parse_partial("かき"),
+                         ("KA", "き"))
+        self.assertEqual(mapping.Mapping({"a": "A", "abc": "C"}).parse_partial("xaab"),
+                         ("xA", "ab"))
+
+    def test_incremental(self):
+        ime = IncrementalConverter("hepburn", "hiragana")
+        self.assertEqual(ime.feed("ka"), ("か", ""))
+        self.assertEqual(ime.feed("n"), ("", "n"))
+        self.assertEqual(ime.preview(), "ん")
+        self.assertEqual(ime.feed("'"), ("", "n'"))
+        self.assertEqual(ime.feed("y"), ("", "n'y"))
+        self.assertEqual(ime.feed("a"), ("んや", ""))
+        self.assertEqual(ime.feed("k"), ("", "k"))
+        self.assertEqual(ime.feed("k"), ("", "kk"))
+        self.assertEqual(ime.feed("a"), ("っか", ""))
+        self.assertEqual(ime.feed("n"), ("", "n"))
+        self.assertEqual(ime.flush(), "ん")
+        self.assertEqual(ime.pending, "")
+
+    def test_incremental_keystrokes(self):
+        text = "tōkyō de shinbun wo yomu. matcha, kon'ya"
+        ime = IncrementalConverter("hepburn", "hiragana")
+        out = "".join(ime.feed(char)[0] for char in text) + ime.flush()
+        self.assertEqual(out, convert(text, "hepburn", "hiragana"))
+
+    def test_stats(self):
+        reset_stats()
+        enable_stats()
+        try:
+            convert("しんぶん、 まっちゃ", "hiragana", "hepburn")
+        finally:
+            enable_stats(False)
+        convert("しんぶん", "hiragana", "hepburn")  # not recorded
+        snapshot = get_stats()
+        self.assertEqual(snapshot[:9], (1, 10, 15, 6, 2, 4, 2, 1, 0))
+        self.assertEqual(snapshot.merged(snapshot).calls, 2)
+        reset_stats()
+        self.assertEqual(get_stats().calls, 0)
+
+    def test_errors(self):
+        in_str = "しんぶん、 ま!ちゃ"
+        self.assertEqual(convert(in_str, "hiragana", "hepburn", errors="report"),
+                         ("shinbun、 ma!cha", [(4, 6), (7, 8)]))
+        self.assertEqual(convert(in_str, "hiragana", "hepburn", errors="replace"),
+                         "shinbun\ufffd\ufffdma\ufffdcha")
+        with self.assertRaises(mapping.ConversionError) as context:
+            convert(in_str, "hiragana", "hepburn", errors="strict")
+        self.assertEqual((context.exception.start, context.exception.end), (4, 5))
+        self.assertEqual(convert("しんぶん", "hiragana", "hepburn", errors="strict"),
+                         "shinbun")
+        self.assertRaises(ValueError, convert, "", "hiragana", "hepburn",
+                          errors="klingon")
+        for option in ({"memoize": True}, {"mixed": True}):
+            self.assertRaises(ValueError, convert, in_str, "hiragana",
+                              "hepburn", errors="report", **option)
+
+    def test_errors_unspellable(self):
+        # lemmas the output format has no spelling for
+        for in_str, out_str in [("ぁ", "xa"), ("ゎ", "xwa"), ("てぃ", "texi"),
+                                ("ゔゃ", "vya")]:
+            self.assertEqual(convert(in_str, "hiragana", "hepburn"), out_str)
+            self.assertEqual(convert(in_str, "hiragana", "hepburn",
+                                     errors="report"),
+                             (out_str, [(0, len(in_str))]))
+            self.assertEqual(convert(in_str, "hiragana", "hepburn",
+                                     errors="replace"),
+                             "\ufffd" * len(in_str))
+            with self.assertRaises(mapping.ConversionError) as context:
+                convert(in_str, "hiragana", "hepburn", errors="strict")
+            self.assertEqual((context.exception.start, context.exception.end),
+                             (0, len(in_str)))
+        self.assertEqual(convert("しんてぃ!", "hiragana", "hepburn",
+                                 errors="report"),
+                         ("shintexi!", [(2, 5)]))
+        self.assertEqual(convert("てぃ", "hiragana", "hepburn",
+                                 out_opts=["extended"], errors="strict"),
+                         convert("てぃ", "hiragana", "hepburn",
+                                 out_opts=["extended"]))
+
+    def test_unspelled_lowercase(self):
+        for out_fmt in ("nihon", "kunrei", "hepburn", "wapuro"):
+            for in_str, in_fmt in [("しんぶん を よむ", "hiragana"),
+                                   ("あっ!", "hiragana"), ("っ", "hiragana"),
+                                   ("ぁ", "hiragana"), ("ヴ", "katakana")]:
+                out_str = convert(in_str, in_fmt, out_fmt)
+                self.assertEqual(out_str, out_str.lower())
+        self.assertEqual(convert("しんぶん を よむ", "hiragana", "hepburn"),
+                         "shinbun o yomu")
+        self.assertEqual(convert("を", "hiragana", "hepburn",
+                                 out_opts=["archaic-w"]), "wo")
+
+    def test_errors_report_matches_parse(self):
+        for in_fmt, in_format in FORMATS.iteritems():
+            for out_fmt in FORMATS:
+                for sample in self.SAMPLES:
+                    in_str = in_format.emit(textformat.HIRAGANA.parse(sample)) + " x"
+                    out_str, spans = convert(in_str, in_fmt, out_fmt,
+                                             errors="report")
+                    self.assertEqual(out_str, convert(in_str, in_fmt, out_fmt))
+                    self.assertEqual(spans[-1][1], len(in_str))
+
+    def test_invalid_format(self):
+        self.assertRaises(ValueError, convert, "a", "klingon", "wapuro")
+
+    def test_options(self):
+        for opts, romaji in [([], "rāmen shinbun matcha"),
+                             (["circumflex"], "râmen shinbun matcha"),
+                             (["double-vowel"], "raamen shinbun matcha"),
+                             (["wapuro-vowels", "traditional", "cch"],
+                              "ra-men shimbun maccha")]:
+            self.assertEqual(
+                convert("らーめん しんぶん まっちゃ", "hiragana", "hepburn",
+                        out_opts=opts),
+                romaji)
+        self.assertEqual(
+            convert("shimbun", "hepburn", "hiragana", in_opts=["traditional"]),
+            "しんぶん")
+        # option variants are built once
+        self.assertIs(common._load_format("hepburn", ["macron"]),
+                      common._load_format("hepburn", ("macron",)))
+
+    def test_invalid_options(self):
+        self.assertRaises(ValueError, convert, "a", "hepburn", "wapuro",
+                          in_opts=["klingon"])
+        self.assertRaises(ValueError, convert, "a", "hiragana", "wapuro",
+                          in_opts=["macron"])
+
+
+class ConcurrencyTestCase(unittest.TestCase):
+
+    THREADS = 8
+
+    def setUp(self):
+        self.inputs = {fmt: [convert(sample, "hiragana", fmt)
+                             for sample in ConvertTestCase.SAMPLES]
+                       for fmt in FORMATS}
+        self.expected = {(in_fmt, out_fmt): [convert(string, in_fmt, out_fmt)
+                                             for string in strings]
+                         for in_fmt, strings in self.inputs.iteritems()
+                         for out_fmt in FORMATS}
+
+    def test_convert_concurrent(self):
+        strings = self.inputs["hiragana"] * 500
+        self.assertEqual(convert_concurrent(strings, "hiragana", "hepburn",
+                                            max_workers=8),
+                         self.expected["hiragana", "hepburn"] * 500)
+        self.assertEqual(convert_concurrent([], "hiragana", "hepburn"), [])
+        self.assertEqual(convert_concurrent(["\ue000し"], "hiragana", "hepburn",
+                                            max_workers=2),
+                         ["\ue000shi"])
+
+    def test_hammer(self):
+        # a tiny pipeline cache, so pipelines are evicted and recompiled
+        #   while other threads use them
+        pipelines = common._PIPELINES
+        common._PIPELINES = util.LRUCache(8)
+        states = {fmt: format_._mapping.__getstate__()
+                  for fmt, format_ in FORMATS.iteritems()}
+        failures = []
+
+        def hammer(seed):
+            pairs = sorted(pair for pair in self.expected
+                           if set(pair) <= {"hiragana", "katakana",
+                                            "kunrei", "hepburn"})
+            pairs = pairs[seed % len(pairs):] + pairs[:seed % len(pairs)]
+            for in_fmt, out_fmt in pairs:
+                strings = self.inputs[in_fmt]
+                results = [convert(string, in_fmt, out_fmt, memoize=seed % 2)
+                           for string in strings]
+                results.append(list(convert_many(strings, in_fmt, out_fmt)))
+                results.append(convert_concurrent(strings * 20, in_fmt,
+                                                  out_fmt, max_workers=3))
+                expected = self.expected[in_fmt, out_fmt]
+                if (results[:-2] != expected or results[-2] != expected or
+                        results[-1] != expected * 20):
+                    failures.append((in_fmt, out_fmt))
+
+        try:
+            threads = [threading.Thread(target=hammer, args=(seed,))
+                       for seed in xrange(self.THREADS)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        finally:
+            common._PIPELINES = pipelines
+        self.assertEqual(failures, [])
+        for fmt, format_ in FORMATS.iteritems():
+            self.assertEqual(format_._mapping.__getstate__(), states[fmt])
+
+
+class LRUCacheTestCase(unittest.TestCase):
+
+    def test_counters(self):
+        cache = util.LRUCache(2)
+        cache.put("a", 1)
+        cache.put("b", 2)
+        self.assertEqual(cache.get("a"), 1)
+        cache.put("c", 3)  # evicts "b"
+        self.assertEqual(cache.get("b"), None)
+        self.assertEqual(cache.info(), util.CacheInfo(hits=1, misses=1,
+                                                      evictions=1, maxsize=2,
+                                                      currsize=2))
+
+    def test_generational(self):
+        cache = util.GenerationalCache(4)
+        cache.put("a", 1)
+        cache.put("b", 2)  # "a" and "b" become the old generation
+        self.assertEqual(cache.get("a"), 1)  # moved back to the new one
+        cache.put("c", 3)  # "b" is evicted
+        self.assertEqual(cache.get("b"), None)
+        self.assertEqual(cache.get("c"), 3)
+        self.assertEqual(cache.info(), util.CacheInfo(hits=2, misses=1,
+                                                      evictions=1, maxsize=4,
+                                                      currsize=2))
+
+
+class CacheTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        cache.CACHE_DIR = self.tmpdir
+
+    def tearDown(self):
+        cache.CACHE_DIR = None
+        shutil.rmtree(self.tmpdir)
+
+    def test_round_trip(self):
+        fmt = FORMATS["hepburn"]
+        cache.save(("format", "test"), fmt.__getstate__())
+        loaded = textformat.RomajiFormat.from_state(cache.load(("format", "test")))
+        self.assertEqual(loaded.emit("KYO-TO-"), fmt.emit("KYO-TO-"))
+        self.assertEqual(loaded.with_options(["circumflex"]).emit("KYO-TO-"),
+                         "kyôtô")
+
+    def test_overlay_round_trip(self):
+        romaji = textformat.get_format("romaji")
+        fmt = FORMATS["kunrei"]
+        cache.save(("format", "test"), fmt.overlay_state())
+        loaded = textformat.RomajiFormat.from_overlay_state(
+            cache.load(("format", "test")), romaji)
+        self.assertEqual(loaded.__getstate__(), fmt.__getstate__())
+        self.assertIs(loaded._mapping._parse_trie["b"]["y"]["o"],
+                      romaji._mapping._parse_trie["b"]["y"]["o"])
+
+    def test_missing_and_corrupt(self):
+        self.assertEqual(cache.load(("missing",)), None)
+        cache.save(("corrupt",), "data")
+        with open(cache._entry_path(("corrupt",)), "wb") as entry:
+            entry.write(b"\xff\x00")
+        self.assertEqual(cache.load(("corrupt",)), None)
+
+    def test_pipeline_cached(self):
+        cache.save(("pipeline", "halfwidth", "nihon", (), ("cch",)),
+                   mapping.Mapping({"あ": "cached"}).__getstate__())
+        self.assertEqual(convert("あ", "halfwidth", "nihon", out_opts=["cch"]),
+                         "cached")
+
+    def test_invalid_names_not_cached(self):
+        # names are checked before the cache is
+        cache.save(("pipeline", "hiragana", "wapuro", (), ("x",)),
+                   mapping.Mapping({"あ": "cached"}).__getstate__())
+        self.assertRaises(ValueError, convert, "あ", "hiragana", "wapuro",
+                          out_opts=["x"])
+        cache.save(("pipeline", "klingon", "wapuro", (), ()),
+                   mapping.Mapping({"あ": "cached"}).__getstate__())
+        self.assertRaises(ValueError, convert, "あ", "klingon", "wapuro")
+
+
+class CLITestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.in_path = os.path.join(self.tmpdir, "in.txt")
+        self.out_path = os.path.join(self.tmpdir, "out.txt")
+        self.lines = ["しんぶん\n", "まっちゃ\n", "らーめん"] * 5
+        with io.open(self.in_path, "w", encoding="utf-8") as in_file:
+            in_file.write("".join(self.lines))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def run_cli(self, *argv):
+        self.assertEqual(
+            cli.main(["-f", "hiragana", "-t", "hepburn",
+                      "-o", self.out_path, self.in_path] + list(argv)),
+            0)
+        with io.open(self.out_path, encoding="utf-8") as out_file:
+            return out_file.read()
+
+    def test_convert_file(self):
+        self.assertEqual(self.run_cli(),
+                         convert("".join(self.lines), "hiragana", "hepburn"))
+
+    def test_count(self):
+        self.assertEqual(cli.main(["count", "-f", "hiragana",
+                                   "-o", self.out_path, self.in_path]), 0)
+        with io.open(self.out_path, encoding="utf-8") as out_file:
+            lines = out_file.read().splitlines()
+        self.assertEqual(lines[0], "N'\t15")
+        self.assertEqual(sorted(lines[1:]),
+                         ["-\t5", "BU\t5", "MA\t5", "ME\t5", "Q\t5",
+                          "RA\t5", "SI\t5", "TYA\t5", "U+000A\t10"])
+
+    def test_jobs(self):
+        shard_lines = cli.SHARD_LINES
+        cli.SHARD_LINES = 2
+        try:
+            self.assertEqual(self.run_cli("--jobs", "3"),
+                             self.run_cli())
+        finally:
+            cli.SHARD_LINES = shard_lines
+
+    def test_stats_jobs(self):
+        shard_lines = cli.SHARD_LINES
+        cli.SHARD_LINES = 2
+        stderr = sys.stderr
+        sys.stderr = io.StringIO()
+        try:
+            self.run_cli("--stats")
+            serial = get_stats()
+            self.run_cli("--stats", "--jobs", "3")
+            parallel = get_stats()
+        finally:
+            sys.stderr = stderr
+            cli.SHARD_LINES = shard_lines
+            reset_stats()
+        self.assertEqual(serial.calls, len("".join(self.lines).splitlines()))
+        self.assertEqual(parallel[:9], serial[:9])
+
+
+class LemmaIndexTestCase(unittest.TestCase):
+
+    DOCS = {1: ("とうきょう しんぶん", "hiragana"),
+            2: ("チーズ・ケーキ", "katakana"),
+            3: ("kyōto no shinbunsha", "hepburn")}
+
+    def setUp(self):
+        self.index = index.LemmaIndex()
+        for doc_id, (text, fmt) in self.DOCS.iteritems():
+            self.index.add(doc_id, text, fmt,
+                           ["macron"] if fmt == "hepburn" else None)
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def check_searches(self, idx):
+        self.assertEqual(idx.search("shinbun", "hepburn"), [1, 3])
+        self.assertEqual(idx.search("sinbun", "nihon"), [1, 3])
+        self.assertEqual(idx.search("シンブン", "katakana"), [1, 3])
+        self.assertEqual(idx.search("tokyo shinbun", "hepburn"), [1])
+        self.assertEqual(idx.search("toukyou", "hepburn"), [1])
+        self.assertEqual(idx.search("kyoto", "hepburn"), [3])
+        self.assertEqual(idx.search("ちーず けーき", "hiragana"), [2])
+        self.assertEqual(idx.search("chiizuke", "hepburn"), [])
+        self.assertEqual(idx.search("bunshi", "hepburn"), [])
+        self.assertEqual(idx.search("!", "hepburn"), [])
+
+    def test_search(self):
+        self.check_searches(self.index)
+        self.assertEqual(len(self.index), 3)
+
+    def test_add_remove(self):
+        self.index.remove(1)
+        self.assertNotIn(1, self.index)
+        self.assertEqual(self.index.search("shinbun", "hepburn"), [3])
+        self.assertRaises(KeyError, self.index.remove, 1)
+        self.index.add(3, "おおさか", "hiragana")
+        self.assertEqual(self.index.search("shinbun", "hepburn"), [])
+        self.assertEqual(self.index.search("osaka", "hepburn"), [3])
+        self.assertEqual(len(self.index), 2)
+
+    def test_save_load(self):
+        path = os.path.join(self.tmpdir, "catalog.idx")
+        self.index.save(path)
+        loaded = index.LemmaIndex.load(path)
+        try:
+            self.check_searches(loaded)
+            loaded.remove(1)
+            loaded.add(4, "しんぶん", "hiragana")
+            self.assertEqual(loaded.search("shinbun", "hepburn"), [3, 4])
+            loaded.save(path)
+        finally:
+            loaded.close()
+        loaded = index.LemmaIndex.load(path)
+        try:
+            self.assertEqual(loaded.search("shinbun", "hepburn"), [3, 4])
+            self.assertEqual(len(loaded), 3)
+        finally:
+            loaded.close()
+
+        with open(path, "wb") as out_file:
+            out_file.write(b"not an index")
+        self.assertRaises(ValueError, index.LemmaIndex.load, path)
+
+
+class ServerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.batcher = server.Batcher()
+        self.server = server.TCPServer(("127.0.0.1", 0), self.batcher)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+        self.batcher.stop()
+
+    def request(self, *requests):
+        client = socket.create_connection(self.server.server_address)
+        try:
+            client.sendall(b"".join(json.dumps(request).encode("utf-8") + b"\n"
+                                    for request in requests))
+            client.shutdown(socket.SHUT_WR)
+            responses = client.makefile("rb")
+            return [json.loads(line.decode("utf-8")) for line in responses]
+        finally:
+            client.close()
+
+    def test_convert(self):
+        samples = ConvertTestCase.SAMPLES * 10
+        responses = self.request(*[
+            {"id": i, "text": sample, "from": "hiragana", "to": "hepburn"}
+            for i, sample in enumerate(samples)])
+        self.assertEqual(
+            responses,
+            [{"id": i, "text": convert(sample, "hiragana", "hepburn")}
+             for i, sample in enumerate(samples)])
+        metrics = self.request({"metrics": True})[0]["metrics"]
+        self.assertEqual(metrics["requests"], len(samples))
+        self.assertEqual(metrics["queue_depth"], 0)
+
+    def test_errors(self):
+        responses = self.request(
+            {"id": 1, "text": "あ", "from": "klingon", "to": "hepburn"},
+            {"id": 2, "text": "あ", "from": "hiragana"},
+            {"id": 3, "text": "あ", "from": "hiragana", "to": "katakana"})
+        self.assertIn("error", responses[0])
+        self.assertIn("error", responses[1])
+        self.assertEqual(responses[2], {"id": 3, "text": "ア"})
+
+    def test_unexpected_error(self):
+        convert_many = common.convert_many
+
+        def failing(strings, in_fmt, *args):
+            if in_fmt == "katakana":
+                raise RuntimeError("broken")
+            return convert_many(strings, in_fmt, *args)
+
+        common.convert_many = failing
+        try:
+            responses = self.request(
+                {"id": 1, "text": "ア", "from": "katakana", "to": "hepburn"},
+                {"id": 2, "text": "あ", "from": "hiragana", "to": "hepburn"})
+        finally:
+            common.convert_many = convert_many
+        self.assertEqual(responses[0],
+                         {"id": 1, "error": "Conversion failed: RuntimeError: broken"})
+        self.assertEqual(responses[1], {"id": 2, "text": "a"})
+        # the batcher is still running
+        self.assertEqual(self.request({"text": "あ", "from": "hiragana",
+                                       "to": "hepburn"}), [{"text": "a"}])
+
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file